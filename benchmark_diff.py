@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+'''
+Diff Benchmark - compares the in-process diff engine used by post-review
+with rbdiff, both in output and in speed.
+
+OLD and NEW may be two files or two directories. Directories are compared
+file by file, so the benchmark can be run on real changelists by syncing or
+exporting the base and the changed revisions into two directory trees, e.g.
+
+    p4 -c base-client sync //depot/project/...@1233
+    p4 -c change-client sync //depot/project/...@1234
+    benchmark_diff.py /ws/base/project /ws/change/project
+'''
+
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+from scm.diffutils import diff_buffers
+
+
+def collect_pairs(old, new):
+    """
+    Returns the list of (old_file, new_file) pairs to compare. Files that
+    only exist on one side are compared against a missing file.
+    """
+    if not os.path.isdir(old) and not os.path.isdir(new):
+        return [(old, new)]
+
+    names = set()
+    for root in (old, new):
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                names.add(os.path.relpath(os.path.join(dirpath, filename), root))
+
+    return [(os.path.join(old, name), os.path.join(new, name))
+            for name in sorted(names)]
+
+
+def read_file(filename):
+    if not os.path.exists(filename):
+        return ""
+
+    f = open(filename, "rb")
+    data = f.read()
+    f.close()
+    return data
+
+
+def run_diff_cmd(diff_cmd, old_file, new_file):
+    p = subprocess.Popen([diff_cmd, "-urNp", old_file, new_file],
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    data = p.communicate()[0]
+
+    # Diff returns "1" if differences were found.
+    if p.returncode not in (0, 1):
+        raise Exception("%s failed for %s and %s:\n%s" % \
+                        (diff_cmd, old_file, new_file, data))
+
+    return data.splitlines(True)
+
+
+def normalize(lines):
+    """
+    Strips the information that legitimately differs between the two
+    implementations: the file names and timestamps in the headers and the
+    wording of the binary file message.
+    """
+    if len(lines) == 1 and (lines[0].startswith("Files ") or \
+                            lines[0].startswith("Binary files ")):
+        return "binary\n"
+
+    return ''.join(lines[2:])
+
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] OLD NEW [OLD NEW ...]")
+    parser.add_option("-n", "--runs",
+                      dest="runs", type="int", default=1,
+                      help="number of times to diff every file pair")
+    parser.add_option("--diff-cmd",
+                      dest="diff_cmd", default="rbdiff",
+                      help="the external diff tool to compare against")
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose", default=False,
+                      help="show the differing output of mismatching files")
+
+    (options, args) = parser.parse_args(args)
+
+    if not args or len(args) % 2:
+        parser.error("OLD and NEW have to be given in pairs")
+
+    pairs = []
+    for i in range(0, len(args), 2):
+        pairs += collect_pairs(args[i], args[i + 1])
+
+    external_time = internal_time = 0.0
+    mismatches = []
+
+    for old_file, new_file in pairs:
+        start = time.time()
+        for i in range(options.runs):
+            external = run_diff_cmd(options.diff_cmd, old_file, new_file)
+        external_time += time.time() - start
+
+        start = time.time()
+        for i in range(options.runs):
+            old_data = read_file(old_file)
+            new_data = read_file(new_file)
+            internal = diff_buffers(old_data, new_data, old_file, new_file)
+        internal_time += time.time() - start
+
+        if normalize(external) != normalize(internal):
+            mismatches.append(old_file)
+            print "Output differs: %s -> %s" % (old_file, new_file)
+            if options.verbose:
+                print "%s:" % options.diff_cmd
+                sys.stdout.writelines(external)
+                print "in-process:"
+                sys.stdout.writelines(internal)
+
+    print
+    print "Files compared:    %d" % len(pairs)
+    print "Identical output:  %d" % (len(pairs) - len(mismatches))
+    print "%-18s %.3fs" % (options.diff_cmd + ":", external_time)
+    print "%-18s %.3fs" % ("in-process:", internal_time)
+    if internal_time > 0:
+        print "Speedup:           %.1fx" % (external_time / internal_time)
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,183 @@
+'''
+A urllib2 handler that keeps HTTP and HTTPS connections open between
+requests, so that a series of API calls to the same server doesn't pay for
+a new TCP connection and TLS handshake every time.
+'''
+
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+from StringIO import StringIO
+
+
+class ConnectionPool(object):
+    """
+    Idle connections, keyed by scheme and host. A connection is only ever
+    used by one request at a time, so the pool can be shared by threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+
+        # Requests that got a response over a reused connection. Stale
+        # connections that had to be replaced aren't counted.
+        self.reused = 0
+
+    def get(self, key, factory):
+        """
+        Returns an idle connection for the key, or a new one created by the
+        factory, along with whether the connection is being reused.
+        """
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+
+            self.opened += 1
+        finally:
+            self.lock.release()
+
+        return factory(), False
+
+    def count_reuse(self):
+        """
+        Counts a request that got its response over a reused connection.
+        """
+        self.lock.acquire()
+        try:
+            self.reused += 1
+        finally:
+            self.lock.release()
+
+    def put(self, key, conn):
+        """
+        Returns a connection to the pool once its response has been read.
+        """
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(key, []).append(conn)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self.lock.acquire()
+        try:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
+# Shared by all handlers, so that connections outlive a single opener.
+connection_pool = ConnectionPool()
+
+
+def is_closed_status_line(e):
+    """
+    Returns whether a BadStatusLine was raised because the connection was
+    closed before the status line, rather than for a malformed one.
+    """
+    # Older versions of httplib pass the empty line, newer ones a message.
+    return e.line in ("", "''") or \
+           e.line.startswith("No status line received")
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """
+    Replaces the default HTTP and HTTPS handlers, which close the connection
+    after every request.
+    """
+    def __init__(self, pool=None):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool or connection_pool
+
+    def http_open(self, req):
+        return self._open('http', httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._open('https', httplib.HTTPSConnection, req)
+
+    def _open(self, scheme, connection_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers = dict([(name.title(), value)
+                        for name, value in headers.items()])
+        headers['Connection'] = 'keep-alive'
+
+        key = (scheme, host)
+
+        while True:
+            conn, reused = self.pool.get(
+                key, lambda: connection_class(host, timeout=req.timeout))
+
+            # A body that is read while it is sent has to start over when
+            # the request is repeated.
+            if hasattr(req.data, 'seek'):
+                req.data.seek(0)
+
+            # The server may have dropped the idle connection in the
+            # meantime, in which case the request is sent again over a new
+            # one. This is only done if the server can't have received the
+            # request, as requests such as posting a diff must not be
+            # repeated.
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+
+                raise urllib2.URLError(e)
+
+            try:
+                response = conn.getresponse()
+            except httplib.BadStatusLine, e:
+                conn.close()
+
+                # The connection was closed without a single byte of
+                # response, which is how servers close idle connections.
+                if reused and is_closed_status_line(e):
+                    continue
+
+                raise urllib2.URLError(e)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+            if reused:
+                self.pool.count_reuse()
+
+            try:
+                data = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+        resp = urllib.addinfourl(StringIO(data), response.msg,
+                                 req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+
+        return resp
@@ -4,6 +4,7 @@
 Post Review - A Review Board Client
 '''
 
+import collections
 import cookielib
 import difflib
 import getpass
@@ -25,10 +26,17 @@ import string
 import xml.sax
 import xml.sax.handler
 import datetime
+import zlib
 from optparse import OptionParser
 from tempfile import mkstemp
 from urlparse import urljoin, urlparse
 from scm.dtr import DtrBaseClient, DtrVersion, DtrFile, DtrCollection
+from scm.diffutils import diff_buffers, format_timestamp, split_lines, \
+    DiffTooExpensive
+from scm.p4print import read_records, split_print_records, translate_newlines
+from scm.pool import parallel_map
+from scm.cache import FileCache, JsonCache
+from scm import p4session
 from gui.dialogs import AboutBox, ReviewPostedDialog, UpdateAvailableDialog, LoginDialog, PerforceUnavailableDialog
 from gui.preferences import EditPreferences, get_scm_user, get_dtr_server
 import wx
@@ -37,6 +45,7 @@ import threading
 import traceback
 import getpass
 import constants
+import keepalive
 
 try:
     from hashlib import md5
@@ -113,6 +122,42 @@ SUBMIT_AS = None
 PUBLISH = False
 OPEN_BROWSER = False
 
+# Compress diff uploads with gzip. Review Board itself doesn't decompress
+# request bodies, so this is only done for servers that advertise it with
+# an "Accept-Encoding: gzip" response header (RFC 7694), e.g. Apache with
+# mod_deflate's input filter and "Header set Accept-Encoding gzip". Diffs
+# smaller than the threshold (in kilobytes) are sent uncompressed.
+COMPRESS_DIFF = False
+COMPRESS_THRESHOLD = 64
+
+# Let the Perforce server compute the diffs of text files, instead of
+# fetching both revisions of every file and diffing them locally.
+P4_NATIVE_DIFF = False
+
+# Perforce files larger than this (in kilobytes) are listed like binary
+# files instead of being fetched and diffed, and a warning is printed.
+# 0 means no limit.
+P4_MAX_FILE_SIZE = 0
+
+# Changes that would take more work than this to diff in-process (each unit
+# is roughly a microsecond) are diffed with rbdiff instead, which is much
+# faster on big rewrites. None means never.
+DIFF_MAX_COST = 50000
+
+# Number of SCM operations (file fetches, diffs) to run concurrently.
+JOBS = 4
+
+# Maximum size of the cache for depot file revisions, in megabytes.
+CACHE_SIZE = 256
+
+# Number of seconds for which the Review Board repository matching a
+# Subversion repository is remembered.
+REPOSITORY_CACHE_TTL = 24 * 60 * 60
+
+# Number of seconds for which the files of a ClearCase label are
+# remembered. Labels can be moved, so this should be kept short.
+LABEL_CACHE_TTL = 60 * 60
+
 # Debugging.  For development...
 DEBUG = False
 
@@ -123,6 +168,9 @@ DEBUG = False
 user_config = None
 tempfiles = []
 options = None
+file_cache = None
+repository_cache = None
+label_cache = None
 frame = None
 
 mainThread = None
@@ -188,17 +236,7 @@ class SvnRepositoryInfo(RepositoryInfo):
         repositories use the same path, you'll get back self, otherwise you'll
         get a different SvnRepositoryInfo object (with a different path).
         """
-        repositories = server.get_repositories()
-
-        for repository in repositories:
-            if repository['tool'] != 'Subversion':
-                continue
-
-            info = self._get_repository_info(server, repository)
-
-            if not info or self.uuid != info['uuid']:
-                continue
-
+        for info in self._get_matching_repository_infos(server):
             repos_base_path = info['url'][len(info['root_url']):]
             relpath = self._get_relative_path(self.base_path, repos_base_path)
             if relpath:
@@ -208,6 +246,38 @@ class SvnRepositoryInfo(RepositoryInfo):
         # self and hope for the best.
         return self
 
+    def _get_matching_repository_infos(self, server):
+        """
+        Returns the info of all Subversion repositories on the server with
+        the same UUID, in the order the server lists them. As this requires
+        an API call per repository, the repositories are probed concurrently
+        and the result is cached.
+        """
+        key = "svn:%s:%s" % (server.url, self.uuid)
+
+        if repository_cache:
+            infos = repository_cache.get(key)
+            if infos is not None:
+                debug("Using cached repositories for UUID %s" % self.uuid)
+                return infos
+
+        repositories = [repository for repository in server.get_repositories()
+                        if repository['tool'] == 'Subversion']
+
+        def get_info(repository):
+            return self._get_repository_info(server, repository)
+
+        infos = [info for info in parallel_map(get_info, repositories,
+                                               get_job_count())
+                 if info and info['uuid'] == self.uuid]
+
+        # A repository that isn't on the server yet may be added any time,
+        # so a failed lookup is not remembered.
+        if repository_cache and infos:
+            repository_cache.put(key, infos)
+
+        return infos
+
     def _get_repository_info(self, server, repository):
         try:
             return server.get_repository_info(repository['id'])
@@ -290,6 +360,244 @@ class ReviewBoardHTTPPasswordMgr(urllib2.HTTPPasswordMgr):
             return urllib2.HTTPPasswordMgr.find_user_password(self, realm, uri)
 
 
+class ReviewBoardCookieJar(cookielib.MozillaCookieJar):
+    """
+    A cookie jar that keeps track of whether its cookies changed since it was
+    last loaded or saved, so that the cookie file is only written when
+    needed.
+    """
+    def __init__(self, filename):
+        cookielib.MozillaCookieJar.__init__(self, filename)
+        self.changed = False
+        self.save_lock = threading.Lock()
+
+    def set_cookie(self, cookie):
+        self._cookies_lock.acquire()
+        try:
+            try:
+                old = self._cookies[cookie.domain][cookie.path][cookie.name]
+                if old.value != cookie.value or old.expires != cookie.expires:
+                    self.changed = True
+            except KeyError:
+                self.changed = True
+
+            cookielib.MozillaCookieJar.set_cookie(self, cookie)
+        finally:
+            self._cookies_lock.release()
+
+    def clear(self, domain=None, path=None, name=None):
+        cookielib.MozillaCookieJar.clear(self, domain, path, name)
+        self.changed = True
+
+    def load(self, filename=None, ignore_discard=False, ignore_expires=False):
+        cookielib.MozillaCookieJar.load(self, filename, ignore_discard,
+                                        ignore_expires)
+        self.changed = False
+
+    def save_if_changed(self):
+        """
+        Writes the cookie file if any cookie changed. The file is written
+        to a temporary file first and then renamed, so that other threads
+        and processes never read a partially written file.
+        """
+        self.save_lock.acquire()
+        try:
+            if not self.changed:
+                return
+
+            # Clear the flag first, so that changes made while saving get
+            # saved the next time.
+            self.changed = False
+
+            fd, tmpfile = mkstemp(prefix=".post-review-cookies",
+                                  dir=os.path.dirname(self.filename) or ".")
+            os.close(fd)
+
+            try:
+                self.save(tmpfile)
+
+                try:
+                    os.rename(tmpfile, self.filename)
+                except OSError:
+                    # Windows doesn't replace existing files on rename.
+                    os.remove(self.filename)
+                    os.rename(tmpfile, self.filename)
+            except (IOError, OSError), e:
+                self.changed = True
+                debug("Couldn't save cookie file: %s" % e)
+
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+        finally:
+            self.save_lock.release()
+
+
+class MultipartBody(object):
+    """
+    A request body made up of strings and file objects, which is read part
+    by part while it is sent. Unlike a joined string, this doesn't copy
+    large diffs, and its length is known up front.
+    """
+    def __init__(self, parts):
+        self.parts = []
+        self.length = 0
+
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode("utf-8")
+
+            if isinstance(part, str):
+                self.length += len(part)
+            else:
+                part.seek(0, 2)
+                self.length += part.tell()
+
+            self.parts.append(part)
+
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        """
+        Rewinds the body, so that it can be sent again, e.g. after an
+        authentication request. Only seeking to the start is supported.
+        """
+        if offset != 0 or whence != 0:
+            raise IOError("MultipartBody can only be rewound")
+
+        self.index = 0
+        self.offset = 0
+
+        for part in self.parts:
+            if not isinstance(part, str):
+                part.seek(0)
+
+    def read(self, size=-1):
+        chunks = []
+
+        while self.index < len(self.parts) and size != 0:
+            part = self.parts[self.index]
+
+            if isinstance(part, str):
+                if size < 0:
+                    end = len(part)
+                else:
+                    end = self.offset + size
+
+                chunk = part[self.offset:end]
+                self.offset += len(chunk)
+            else:
+                chunk = part.read(size)
+
+            if not chunk:
+                self.index += 1
+                self.offset = 0
+                continue
+
+            chunks.append(chunk)
+
+            if size > 0:
+                size -= len(chunk)
+
+        return ''.join(chunks)
+
+
+class GzipBody(object):
+    """
+    Compresses a request body into the gzip format while it is read. The
+    compressed length is needed up front for the Content-Length header, so
+    the body is compressed once beforehand without keeping the output.
+    """
+    block_size = 65536
+
+    def __init__(self, body):
+        self.body = body
+        self.length = 0
+
+        self.seek(0)
+        while True:
+            chunk = self.read(self.block_size)
+            if not chunk:
+                break
+
+            self.length += len(chunk)
+
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        """
+        Rewinds the body, so that it can be sent again. Only seeking to the
+        start is supported.
+        """
+        if offset != 0 or whence != 0:
+            raise IOError("GzipBody can only be rewound")
+
+        self.body.seek(0)
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.finished = False
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            block = self.body.read(self.block_size)
+            if block:
+                self.buffer += self.compressor.compress(block)
+            else:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+
+        return chunk
+
+
+class ReviewBoardSession(object):
+    """
+    The state of the connection to a Review Board server, shared by all
+    ReviewBoardServer instances for that server within one run.
+    """
+    def __init__(self, cookie_file):
+        self.cookie_jar = ReviewBoardCookieJar(cookie_file)
+        # Whether the cookie file has been loaded into the cookie jar.
+        self.cookies_loaded = False
+        # The server repository info, keyed by local repository path and
+        # base path, and the lock guarding it.
+        self.server_info = {}
+        self.server_info_lock = threading.Lock()
+        # The content codings the server accepts for request bodies, as
+        # advertised in its responses.
+        self.request_encodings = set()
+
+
+# Review Board sessions, keyed by server URL and cookie file.
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_session(url, cookie_file):
+    """
+    Returns the session for a Review Board server, creating it on first use.
+    """
+    sessions_lock.acquire()
+    try:
+        key = (url, cookie_file)
+        if key not in sessions:
+            sessions[key] = ReviewBoardSession(cookie_file)
+
+        return sessions[key]
+    finally:
+        sessions_lock.release()
+
+
 class ReviewBoardServer(object):
     """
     An instance of a Review Board server.
@@ -299,19 +607,22 @@ class ReviewBoardServer(object):
         if self.url[ - 1] != '/':
             self.url += '/'
         self._info = info
-        self._server_info = None
         self.cookie_file = cookie_file
-        self.cookie_jar = cookielib.MozillaCookieJar(self.cookie_file)
+        self.session = get_session(self.url, cookie_file)
+        self.cookie_jar = self.session.cookie_jar
 
         # Set up the HTTP libraries to support all of the features we need.
         cookie_handler = urllib2.HTTPCookieProcessor(self.cookie_jar)
         password_mgr = ReviewBoardHTTPPasswordMgr(self.url)
         auth_handler = urllib2.HTTPBasicAuthHandler(password_mgr)
         proxy_support = urllib2.ProxyHandler({})
+        keepalive_handler = keepalive.KeepAliveHandler()
 
-        opener = urllib2.build_opener(cookie_handler, auth_handler, proxy_support)
-        opener.addheaders = [('User-agent', 'post-review/' + constants.VERSION)]
-        urllib2.install_opener(opener)
+        # The opener is kept per server instead of being installed globally,
+        # since the GUI may talk to several servers from different threads.
+        self.opener = urllib2.build_opener(cookie_handler, auth_handler,
+                                           proxy_support, keepalive_handler)
+        self.opener.addheaders = [('User-agent', 'post-review/' + constants.VERSION)]
 
     def login(self):
         """
@@ -366,41 +677,71 @@ class ReviewBoardServer(object):
                                                rsp["err"]["code"]))
 
         debug("Logged in.")
+        self.save_cookies()
+
+    def save_cookies(self):
+        """
+        Writes the cookies received from the server to the cookie file, if
+        they changed.
+        """
+        self.cookie_jar.save_if_changed()
 
     def has_valid_cookie(self):
         """
         Load the user's cookie file and see if they have a valid
         'rbsessionid' cookie for the current Review Board server.  Returns
-        true if so and false otherwise.
+        true if so and false otherwise. The cookie file is only loaded once
+        per run, after that the cookies kept in the session are used.
         """
-        try:
-            parsed_url = urlparse(self.url)
-            host = parsed_url[1]
-            path = parsed_url[2] or '/'
+        host, path = self._get_cookie_location()
 
-            # Cookie files don't store port numbers, unfortunately, so
-            # get rid of the port number if it's present.
-            host = host.split(":")[0]
+        if not self.session.cookies_loaded:
+            try:
+                debug("Looking for '%s %s' cookie in %s" % \
+                      (host, path, self.cookie_file))
+                self.cookie_jar.load(self.cookie_file, ignore_expires=True)
+            except IOError, error:
+                debug("Couldn't load cookie file: %s" % error)
+                return False
 
-            debug("Looking for '%s %s' cookie in %s" % \
-                  (host, path, self.cookie_file))
-            self.cookie_jar.load(self.cookie_file, ignore_expires=True)
+            self.session.cookies_loaded = True
 
-            try:
-                cookie = self.cookie_jar._cookies[host][path]['rbsessionid']
+        try:
+            cookie = self.cookie_jar._cookies[host][path]['rbsessionid']
 
-                if not cookie.is_expired():
-                    debug("Loaded valid cookie -- no login required")
-                    return True
+            if not cookie.is_expired():
+                debug("Loaded valid cookie -- no login required")
+                return True
 
-                debug("Cookie file loaded, but cookie has expired")
-            except KeyError:
-                debug("Cookie file loaded, but no cookie for this server")
-        except IOError, error:
-            debug("Couldn't load cookie file: %s" % error)
+            debug("Cookie file loaded, but cookie has expired")
+        except KeyError:
+            debug("Cookie file loaded, but no cookie for this server")
 
         return False
 
+    def clear_session_cookie(self):
+        """
+        Forgets the session cookie, e.g. after the server reported that it
+        is no longer logged in, so that the next login() logs in again.
+        """
+        host, path = self._get_cookie_location()
+
+        try:
+            self.cookie_jar.clear(host, path, 'rbsessionid')
+        except KeyError:
+            pass
+
+    def _get_cookie_location(self):
+        parsed_url = urlparse(self.url)
+        host = parsed_url[1]
+        path = parsed_url[2] or '/'
+
+        # Cookie files don't store port numbers, unfortunately, so
+        # get rid of the port number if it's present.
+        host = host.split(":")[0]
+
+        return host, path
+
     def new_review_request(self, changenum, submit_as=None):
         """
         Creates a review request on a Review Board server, updating an
@@ -450,6 +791,37 @@ class ReviewBoardServer(object):
             field: value,
         })
 
+    def set_review_request_fields(self, review_request, fields):
+        """
+        Sets several fields in a review request, given as a list of
+        (field, value) pairs, with a single request. If the server rejects
+        the batch, the fields are set one by one.
+        """
+        if len(fields) == 1:
+            field, value = fields[0]
+            self.set_review_request_field(review_request, field, value)
+            return
+
+        rid = review_request['id']
+
+        debug("Attempting to set fields %s for review request '%s'" %
+              (', '.join([field for field, value in fields]), rid))
+
+        try:
+            self.api_post('api/json/reviewrequests/%s/draft/set/' % rid,
+                          dict(fields))
+        except APIError, e:
+            rsp, = e.args
+
+            if rsp['err']['code'] == 103: # Not logged in
+                raise
+
+            debug("Setting the fields at once failed (%s), setting them "
+                  "one by one" % rsp['err']['msg'])
+
+            for field, value in fields:
+                self.set_review_request_field(review_request, field, value)
+
     def get_review_request(self, rid):
         """
         Returns the review request with the specified ID.
@@ -505,8 +877,17 @@ class ReviewBoardServer(object):
                 'content': parent_diff_content
             }
 
+        size = len(diff_content) + len(parent_diff_content or '')
+        compress = options.compress_diff and \
+                   size >= options.compress_threshold * 1024
+
+        if compress and 'gzip' not in self.session.request_encodings:
+            debug("The server doesn't accept compressed requests, "
+                  "sending the diff uncompressed")
+            compress = False
+
         self.api_post('api/json/reviewrequests/%s/diff/new/' % 
-                      review_request['id'], fields, files)
+                      review_request['id'], fields, files, compress)
 
     def publish(self, review_request):
         """
@@ -517,10 +898,23 @@ class ReviewBoardServer(object):
                       review_request['id'])
 
     def _get_server_info(self):
-        if not self._server_info:
-            self._server_info = self._info.find_server_repository_info(self)
+        # The base path of the server repository depends on the directory
+        # the diff is made in, not just on the repository.
+        key = (self._info.path, self._info.base_path)
+
+        # The lookup is done while holding the lock, so that posts running
+        # at the same time don't all query the server.
+        self.session.server_info_lock.acquire()
+        try:
+            server_info = self.session.server_info.get(key)
 
-        return self._server_info
+            if not server_info:
+                server_info = self._info.find_server_repository_info(self)
+                self.session.server_info[key] = server_info
+        finally:
+            self.session.server_info_lock.release()
+
+        return server_info
 
     info = property(_get_server_info)
 
@@ -538,17 +932,15 @@ class ReviewBoardServer(object):
 
     def http_get(self, path):
         """
-        Performs an HTTP GET on the specified path, storing any cookies that
-        were set.
+        Performs an HTTP GET on the specified path. Any cookies that were set
+        are kept in the cookie jar until save_cookies is called.
         """
         debug('HTTP GETting %s' % path)
 
         url = self._make_url(path)
 
         try:
-            rsp = urllib2.urlopen(url).read()
-            self.cookie_jar.save(self.cookie_file)
-            return rsp
+            return self._open(url).read()
         except urllib2.HTTPError, e:
             error("Unable to access %s (%s). The host path may be invalid" % \
                 (url, e.code))
@@ -558,6 +950,24 @@ class ReviewBoardServer(object):
                 pass
             die()
 
+    def _open(self, request):
+        """
+        Opens a URL or request with the opener of this server, noting the
+        request body codings the server accepts.
+        """
+        rsp = self.opener.open(request)
+
+        # RFC 7694: servers list the codings they accept for request
+        # bodies in the Accept-Encoding header of their responses.
+        accept_encoding = rsp.info().getheader('Accept-Encoding')
+        if accept_encoding:
+            for coding in accept_encoding.split(','):
+                coding = coding.split(';')[0].strip().lower()
+                if coding:
+                    self.session.request_encodings.add(coding)
+
+        return rsp
+
     def _make_url(self, path):
         """Given a path on the server returns a full http:// style url"""
         app = urlparse(self.url)[2]
@@ -576,10 +986,11 @@ class ReviewBoardServer(object):
         """
         return self.process_json(self.http_get(path))
 
-    def http_post(self, path, fields, files=None):
+    def http_post(self, path, fields, files=None, compress=False):
         """
-        Performs an HTTP POST on the specified path, storing any cookies that
-        were set.
+        Performs an HTTP POST on the specified path. Any cookies that were set
+        are kept in the cookie jar until save_cookies is called. If compress
+        is set, the request body is sent gzipped.
         """
         if fields:
             debug_fields = fields.copy()
@@ -594,17 +1005,23 @@ class ReviewBoardServer(object):
         content_type, body = self._encode_multipart_formdata(fields, files)
         headers = {
             'Content-Type': content_type,
-            'Content-Length': str(len(body))
         }
+
+        if compress:
+            size = len(body)
+            body = GzipBody(body)
+            headers['Content-Encoding'] = 'gzip'
+            debug("Compressed request body from %d to %d bytes (%.1f%%)" %
+                  (size, len(body), 100.0 * len(body) / max(size, 1)))
+
+        headers['Content-Length'] = str(len(body))
         
         # debug("headers = %s" % headers)
         # debug("body = %s" % body)
 
         try:
             r = urllib2.Request(url, body, headers)
-            data = urllib2.urlopen(r).read()
-            self.cookie_jar.save(self.cookie_file)
-            return data
+            return self._open(r).read()
         except urllib2.URLError, e:
             try:
                 debug(e.read())
@@ -617,51 +1034,57 @@ class ReviewBoardServer(object):
             die("Unable to access %s (%s). The host path may be invalid\n%s" % \
                 (url, e.code, e.read()))
 
-    def api_post(self, path, fields=None, files=None):
+    def api_post(self, path, fields=None, files=None, compress=False):
         """
         Performs an API call using HTTP POST at the specified path.
         """
-        debug("Posting API request: path=%s, fields=%s, files=%s" % (path, fields, files))
-        return self.process_json(self.http_post(path, fields, files))
+        # The file contents are left out, as they may be large diffs.
+        debug("Posting API request: path=%s, fields=%s, files=%s" %
+              (path, fields, [(key, files[key]['filename'])
+                              for key in (files or {})]))
+        return self.process_json(self.http_post(path, fields, files, compress))
 
     def _encode_multipart_formdata(self, fields, files):
         """
-        Encodes data for use in an HTTP POST.
+        Encodes data for use in an HTTP POST. The file contents may be
+        strings or file objects, and are not copied into the body.
         """
         BOUNDARY = mimetools.choose_boundary()
-        content = ""
+        parts = []
 
         fields = fields or {}
         files = files or {}
 
         for key in fields:
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"\r\n" % key
-            content += "\r\n"
-            content += fields[key] + "\r\n"
+            parts.append("--" + BOUNDARY + "\r\n" +
+                         "Content-Disposition: form-data; name=\"%s\"\r\n" % key +
+                         "\r\n")
+            parts.append(fields[key])
+            parts.append("\r\n")
 
         for key in files:
             filename = files[key]['filename']
-            value = files[key]['content']
-            content += "--" + BOUNDARY + "\r\n"
-            content += "Content-Disposition: form-data; name=\"%s\"; " % key
-            content += "filename=\"%s\"\r\n" % filename
-            content += "\r\n"
-            content += value + "\r\n"
+            parts.append("--" + BOUNDARY + "\r\n" +
+                         "Content-Disposition: form-data; name=\"%s\"; " % key +
+                         "filename=\"%s\"\r\n" % filename +
+                         "\r\n")
+            parts.append(files[key]['content'])
+            parts.append("\r\n")
 
-        content += "--" + BOUNDARY + "--\r\n"
-        content += "\r\n"
+        parts.append("--" + BOUNDARY + "--\r\n" +
+                     "\r\n")
 
         content_type = "multipart/form-data; boundary=%s" % BOUNDARY
 
-        return content_type, content.encode("utf-8")
+        return content_type, MultipartBody(parts)
 
 
 
-def execute(command, env=None, split_lines=False, ignore_errors=False,
-            extra_ignore_errors=(), p4_login_fix=False, feed_stdin=None):
+def start_process(command, env=None, raw=False):
     """
-    Utility function to execute a command and return the output.
+    Starts a command with its stderr redirected to its stdout and returns
+    the process. With raw set, stderr is kept apart and the output isn't
+    translated.
     """
     if isinstance(command, list):
         debug(subprocess.list2cmdline(command))
@@ -683,9 +1106,9 @@ def execute(command, env=None, split_lines=False, ignore_errors=False,
         p = subprocess.Popen(command,
                              stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
+                             stderr=raw and subprocess.PIPE or subprocess.STDOUT,
                              shell=True,
-                             universal_newlines=True,
+                             universal_newlines=not raw,
                              env=env,
                              creationflags=0x08000000)
     else:
@@ -695,21 +1118,42 @@ def execute(command, env=None, split_lines=False, ignore_errors=False,
         p = subprocess.Popen(command,
                              stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
+                             stderr=raw and subprocess.PIPE or subprocess.STDOUT,
                              shell=True,
                              close_fds=True,
-                             universal_newlines=True,
+                             universal_newlines=not raw,
                              env=env)
-    if feed_stdin:
-        p.stdin.write(feed_stdin)
-        p.stdin.write('\n')
-    if split_lines:
-        data = p.stdout.readlines()
+
+    return p
+
+def execute(command, env=None, split_lines=False, ignore_errors=False,
+            extra_ignore_errors=(), p4_login_fix=False, feed_stdin=None,
+            raw=False):
+    """
+    Utility function to execute a command and return the output. With raw
+    set, the output is returned exactly as the command wrote it, without
+    the error messages.
+    """
+    p = start_process(command, env, raw)
+    if raw:
+        if feed_stdin:
+            feed_stdin += '\n'
+        data, errors = p.communicate(feed_stdin)
+        messages = errors.splitlines(True)
+        if split_lines:
+            data = data.splitlines(True)
     else:
-        data = p.stdout.read()
+        if feed_stdin:
+            p.stdin.write(feed_stdin)
+            p.stdin.write('\n')
+        if split_lines:
+            data = p.stdout.readlines()
+        else:
+            data = p.stdout.read()
+        messages = data
     rc = p.wait()
     if rc and not ignore_errors and rc not in extra_ignore_errors:
-        if p4_login_fix and len(data) > 0 and (data[0].startswith('Your session has expired, please login again.') or data[0].startswith('Perforce password')):
+        if p4_login_fix and len(messages) > 0 and (messages[0].startswith('Your session has expired, please login again.') or messages[0].startswith('Perforce password')):
             if options.gui:
                 password = wx.GetPasswordFromUser("Your Perforce session has expired. Please log in again.\n\nPassword:", caption = "Post Review", parent = frame)
             else:
@@ -717,12 +1161,59 @@ def execute(command, env=None, split_lines=False, ignore_errors=False,
                 password = getpass.getpass()
             if password:
                 execute(['p4', 'login'], env, feed_stdin = password)
-            return execute(command, env, split_lines, ignore_errors, extra_ignore_errors, False, feed_stdin)
+            return execute(command, env, split_lines, ignore_errors, extra_ignore_errors, False, feed_stdin, raw)
+        elif raw:
+            die('Failed to execute command: %s\n%s' % (command, errors))
         else:
             die('Failed to execute command: %s\n%s' % (command, data))
 
     return data
 
+def execute_lines(command, env=None):
+    """
+    Utility function to execute a command and yield its output line by line
+    while the command is still running.
+    """
+    p = start_process(command, env)
+    p.stdin.close()
+
+    # The last lines are kept for the error message.
+    tail = collections.deque(maxlen=20)
+
+    try:
+        for line in iter(p.stdout.readline, ''):
+            tail.append(line)
+            yield line
+    finally:
+        p.stdout.close()
+        rc = p.wait()
+
+    if rc:
+        die('Failed to execute command: %s\n%s' % (command, ''.join(tail)))
+
+def execute_marshalled(command, env=None, ignore_errors=False):
+    """
+    Utility function to execute a command that writes marshalled Python
+    records, such as "p4 -G", and return the list of records.
+    """
+    p = start_process(command, env, raw=True)
+    p.stdin.close()
+
+    try:
+        try:
+            records = read_records(p.stdout)
+        except ValueError:
+            die('Unable to read the output of %s' % command)
+    finally:
+        p.stdout.close()
+        errors = p.stderr.read()
+        rc = p.wait()
+
+    if rc and not ignore_errors:
+        die('Failed to execute command: %s\n%s' % (command, errors))
+
+    return records
+
 class SCMChange(object):
     def __init__(self, id, description, branch = None):
         self.id = id
@@ -866,6 +1357,15 @@ class ClearCaseClient(SCMClient):
     viewinfo = ""
     viewtype = "snapshot"
 
+    # Number of elements described by a single cleartool call, which keeps
+    #   the command line within the limits of Windows.
+    describe_batch_size = 50
+
+    def __init__(self):
+        SCMClient.__init__(self)
+        # Versions of the directory elements, looked up once per diff.
+        self.dir_versions = {}
+
     def get_filename_hash(self, fname):
         # Hash the filename string so its easy to find the file later on.
         return md5(fname).hexdigest()
@@ -896,6 +1396,7 @@ class ClearCaseClient(SCMClient):
             drive_letter = curdir[where:where + 1]
             curdir = drive_letter + ":\\" + curdir[where + 2:len(curdir)]
 
+        elem_paths = []
         for key in files:
             # Sometimes there is a quote in the filename. It must be removed.
             key = key.replace('\'', '')
@@ -907,13 +1408,24 @@ class ClearCaseClient(SCMClient):
             if elem_path_idx != - 1:
                 elem_path = elem_path[elem_path_idx:len(elem_path)].strip("\"")
 
+            elem_paths.append(elem_path)
+
+        def describe_previous(elem_path):
             # Call cleartool to get this version and the previous version
             #   of the element.
             curr_version, pre_version = execute(
                 ["cleartool", "desc", "-pre", elem_path])
             curr_version = cpath.normpath(curr_version)
             pre_version = pre_version.split(':')[1].strip()
+            return curr_version, pre_version
 
+        # The elements are described concurrently, but the results come
+        #   back in the order of the files.
+        descriptions = parallel_map(describe_previous, elem_paths,
+                                    get_job_count())
+
+        for elem_path, (curr_version, pre_version) in zip(elem_paths,
+                                                          descriptions):
             # If a specific version was given, remove it from the path
             #   to avoid version duplication
             if "@@" in elem_path:
@@ -935,6 +1447,23 @@ class ClearCaseClient(SCMClient):
 
         evfiles = []
         hlist = []
+        # (temp file, version) pairs to fetch from the server.
+        fetches = []
+
+        # Describe all directories of the checked in files at once. Files
+        #   in the same folder share most of their directories.
+        self.dir_versions = {}
+        dirs = []
+        for vkey in versions:
+            if "CHECKEDOUT" not in vkey:
+                bpath, splversions, fname = self.split_version_path(vkey)
+                elem_path = bpath
+
+                for key in splversions:
+                    elem_path = cpath.join(elem_path, key)
+                    dirs.append(cpath.normpath(elem_path))
+
+        self.describe_directories(dirs)
 
         for vkey in versions:
             # Verify if it is a checkedout file.
@@ -946,30 +1475,7 @@ class ClearCaseClient(SCMClient):
             else:
                 # For checkedin files.
                 ext_path = []
-                ver = []
-                fname = ""      # fname holds the file name without the version.
-                (bpath, fpath) = cpath.splitdrive(vkey)
-                if bpath :
-                    # Windows.
-                    # The version (if specified like file.c@@/main/1)
-                    #   should be kept as a single string
-                    #   so split the path and concat the file name
-                    #   and version in the last position of the list.
-                    ver = fpath.split("@@")
-                    splversions = fpath[:vkey.rfind("@@")].split("\\")
-                    fname = splversions.pop()
-                    splversions.append(fname + ver[1])
-                else :
-                    # Linux.
-                    bpath = vkey[:vkey.rfind("vobs") + 4]
-                    fpath = vkey[vkey.rfind("vobs") + 5:]
-                    ver = fpath.split("@@")
-                    splversions = ver[0][:vkey.rfind("@@")].split("/")
-                    fname = splversions.pop()
-                    splversions.append(fname + ver[1])
-
-                filename = splversions.pop()
-                bpath = cpath.normpath(bpath + "/")
+                bpath, splversions, fname = self.split_version_path(vkey)
                 elem_path = bpath
 
                 for key in splversions:
@@ -979,9 +1485,8 @@ class ClearCaseClient(SCMClient):
 
                     # This is the version to be appended to the extended
                     #   path list.
-                    this_version = execute(
-                        ["cleartool", "desc", "-fmt", "%Vn",
-                        cpath.normpath(elem_path)])
+                    this_version = self.describe_directories(
+                        [cpath.normpath(elem_path)])[0]
                     if this_version:
                         ext_path.append(key + "/@@" + this_version + "/")
                     else:
@@ -1029,37 +1534,140 @@ class ClearCaseClient(SCMClient):
                         if cpath.exists(tf):
                             debug("WARNING: FILE EXISTS")
                             os.unlink(tf)
-                        execute(["cleartool", "get", "-to", tf, normkey])
+                        fetches.append((tf, normkey))
                     else:
                         die("ERROR: FILE NOT FOUND : %s" % epstr)
 
+        # Every version goes to its own temp file, so they can all be
+        #   fetched at the same time.
+        def get_version(fetch):
+            tf, normkey = fetch
+            execute(["cleartool", "get", "-to", tf, normkey])
+
+        parallel_map(get_version, fetches, get_job_count())
+
         return evfiles
 
+    def split_version_path(self, vkey):
+        """
+        Splits the path of a checked in version into the base path, the
+        directories below it and the file name without the version.
+        """
+        ver = []
+        fname = ""      # fname holds the file name without the version.
+        (bpath, fpath) = cpath.splitdrive(vkey)
+        if bpath :
+            # Windows.
+            # The version (if specified like file.c@@/main/1)
+            #   should be kept as a single string
+            #   so split the path and concat the file name
+            #   and version in the last position of the list.
+            ver = fpath.split("@@")
+            splversions = fpath[:vkey.rfind("@@")].split("\\")
+            fname = splversions.pop()
+            splversions.append(fname + ver[1])
+        else :
+            # Linux.
+            bpath = vkey[:vkey.rfind("vobs") + 4]
+            fpath = vkey[vkey.rfind("vobs") + 5:]
+            ver = fpath.split("@@")
+            splversions = ver[0][:vkey.rfind("@@")].split("/")
+            fname = splversions.pop()
+            splversions.append(fname + ver[1])
+
+        filename = splversions.pop()
+        bpath = cpath.normpath(bpath + "/")
+
+        return bpath, splversions, fname
+
+    def describe_directories(self, dirs):
+        """
+        Returns the versions of the given directory elements. Each directory
+        is only described once per diff, and the ones not known yet are
+        described in batches with a single cleartool call each.
+        """
+        missing = []
+        for elem_path in dirs:
+            if elem_path not in self.dir_versions and elem_path not in missing:
+                missing.append(elem_path)
+
+        for i in range(0, len(missing), self.describe_batch_size):
+            batch = missing[i:i + self.describe_batch_size]
+            if len(batch) < 2:
+                break
+
+            data = execute(["cleartool", "desc", "-fmt", "%Vn\\n"] + batch,
+                           ignore_errors=True)
+            batch_versions = data.splitlines()
+
+            # Errors would shift the versions against the directories, so
+            #   the batch is only used if every directory was described.
+            if len(batch_versions) == len(batch) and \
+               "cleartool: Error" not in data:
+                self.dir_versions.update(zip(batch, batch_versions))
+
+        for elem_path in missing:
+            if elem_path not in self.dir_versions:
+                self.dir_versions[elem_path] = execute(
+                    ["cleartool", "desc", "-fmt", "%Vn", elem_path])
+
+        return [self.dir_versions[elem_path] for elem_path in dirs]
+
     def get_files_from_label(self, label):
-        voblist = []
+        key = "cc:%s" % label
+
+        if label_cache:
+            filelist = label_cache.get(key)
+            if filelist:
+                debug("Using cached files for label %s" % label)
+
+                # The cache file holds the paths as JSON strings, which come
+                # back as unicode. Return the same UTF-8 encoded byte
+                # strings cleartool prints, which get_filename_hash needs.
+                return set([isinstance(path, unicode) and
+                            path.encode('utf-8') or path
+                            for path in filelist])
+
         # Get the list of vobs for the current view
         allvoblist = execute(["cleartool", "lsvob", "-short"]).split()
-        # For each vob, find if the label is present
-        for vob in allvoblist:
+
+        # The vobs are independent of each other, so they are scanned
+        #   concurrently. die() raises SystemExit, which must not escape
+        #   the workers for a vob that doesn't have the label.
+        def has_label(vob):
             try:
                 execute(["cleartool", "describe", "-local",
                     "lbtype:%s@%s" % (label, vob)]).split()
-                voblist.append(vob)
+                return True
             except:
-                pass
+                return False
 
-        filelist = []
-        # For each vob containing the label, get the file list
-        for vob in voblist:
+        def find_files(vob):
             try:
                 res = execute(["cleartool", "find", vob, "-all", "-version",
                     "lbtype(%s)" % label, "-print"])
-                filelist.extend(res.split())
+                return res.split()
             except :
-                pass
+                return []
+
+        # For each vob, find if the label is present
+        voblist = [vob for vob, found in
+                   zip(allvoblist, parallel_map(has_label, allvoblist,
+                                                get_job_count()))
+                   if found]
+
+        filelist = []
+        # For each vob containing the label, get the file list
+        for res in parallel_map(find_files, voblist, get_job_count()):
+            filelist.extend(res)
 
         # Return only the unique itens
-        return set(filelist)
+        filelist = set(filelist)
+
+        if label_cache and filelist:
+            label_cache.put(key, sorted(filelist))
+
+        return filelist
 
     def diff(self, files):
         """
@@ -1160,11 +1768,58 @@ class ClearCaseClient(SCMClient):
         return (ostr, None, None) # diff, parent_diff (not supported), branch (not supported)
 
 
+class SvnInfoHandler(xml.sax.handler.ContentHandler):
+    """
+    Collects the entries of "svn info --xml", keyed by path. The entries
+    use the same keys as the plain "svn info" output.
+    """
+    # (parent element, element) -> key
+    KEYS = {
+        ('entry', 'url'): 'URL',
+        ('repository', 'root'): 'Repository Root',
+        ('repository', 'uuid'): 'Repository UUID',
+        ('wc-info', 'copy-from-url'): 'Copied From URL',
+    }
+
+    def __init__(self):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.entries = {}
+        self.entry = None
+        self.elements = []
+        self.buffer = ""
+
+    def startElement(self, name, attributes):
+        if name == 'entry':
+            self.entry = {}
+            path = attributes['path'].encode('utf-8').replace(os.sep, '/')
+            self.entries[path] = self.entry
+
+        self.elements.append(name)
+        self.buffer = ""
+
+    def characters(self, data):
+        self.buffer += data
+
+    def endElement(self, name):
+        key = self.KEYS.get(tuple(self.elements[-2:]))
+        if self.entry is not None and key:
+            self.entry[key] = self.buffer.strip().encode('utf-8')
+        elif name == 'entry':
+            self.entry = None
+
+        self.elements.pop()
+
+
 class SVNClient(SCMClient):
     """
     A wrapper around the svn Subversion tool that fetches repository
     information and generates compatible diffs.
     """
+    def __init__(self):
+        SCMClient.__init__(self)
+        # "svn info" results of the current diff, keyed by path
+        self.svn_info_cache = {}
+
     def get_repository_info(self):
         if not check_install('svn help'):
             return None
@@ -1258,16 +1913,76 @@ class SVNClient(SCMClient):
                                  revision_range],
                                 repository_info)
 
+    # Number of header paths, and maximum number of lines, that are looked
+    # up with a single "svn info" while the output of svn diff is read.
+    SVN_INFO_WINDOW_PATHS = 500
+    SVN_INFO_WINDOW_LINES = 50000
+
     def do_diff(self, cmd, repository_info=None):
         """
         Performs the actual diff operation, handling renames and converting
-        paths to absolute.
+        paths to absolute. The output of svn is processed line by line while
+        svn is still running. The result is a single string, as it is printed
+        and uploaded as one, so the whole diff is still held in memory.
         """
-        diff = execute(cmd, split_lines=True)
+        diff = execute_lines(cmd)
+
+        # Paths are only looked up with "svn info" in a working copy.
+        if not options.repository_url:
+            diff = self.prefetch_svn_info(diff)
+
         diff = self.handle_renames(diff)
         diff = self.convert_to_absolute_paths(diff, repository_info)
 
-        return ''.join(diff)
+        try:
+            # Only the rewriting overlaps with svn running. The memory used
+            # still grows with the size of the diff.
+            return ''.join(diff)
+        finally:
+            self.svn_info_cache = {}
+
+    def prefetch_svn_info(self, diff_content):
+        """
+        Passes the diff lines through, looking up the paths in the file
+        headers ahead of time. The lines are buffered in windows, and all
+        new paths of a window are looked up with a single "svn info".
+        """
+        window = []
+        paths = []
+
+        for line in diff_content:
+            window.append(line)
+
+            path = self.get_header_path(line)
+            if path and path not in self.svn_info_cache and path not in paths:
+                paths.append(path)
+
+            if len(paths) >= self.SVN_INFO_WINDOW_PATHS or \
+               len(window) >= self.SVN_INFO_WINDOW_LINES:
+                self.svn_info_cache.update(self.svn_info_batch(paths))
+
+                for buffered_line in window:
+                    yield buffered_line
+
+                window = []
+                paths = []
+
+        self.svn_info_cache.update(self.svn_info_batch(paths))
+
+        for line in window:
+            yield line
+
+    def get_header_path(self, line):
+        """
+        Returns the relative path in a file header line of a diff, or None
+        for any other line.
+        """
+        if line.startswith('+++ ') or line.startswith('--- ') or line.startswith('Index: '):
+            line = line.split(" ", 1)[1]
+            if not line.startswith('/'):
+                return self.parse_filename_header(line)[0]
+
+        return None
 
     def handle_renames(self, diff_content):
         """
@@ -1275,16 +1990,17 @@ class SVNClient(SCMClient):
         into being via svn mv/cp. Although the patch for these files are
         relative to its parent, the diff header doesn't reflect this.
         This function fixes the relevant section headers of the patch to
-        portray this relationship.
+        portray this relationship. The lines are passed through as a
+        generator.
         """
 
         # svn diff against a repository URL on two revisions appears to
         # handle moved files properly, so only adjust the diff file names
         # if they were created using a working copy.
         if options.repository_url:
-            return diff_content
-
-        result = []
+            for line in diff_content:
+                yield line
+            return
 
         from_line = ""
         for line in diff_content:
@@ -1300,15 +2016,13 @@ class SVNClient(SCMClient):
                     url = info["Copied From URL"]
                     root = info["Repository Root"]
                     from_file = urllib.unquote(url[len(root):])
-                    result.append(from_line.replace(to_file, from_file))
+                    yield from_line.replace(to_file, from_file)
                 else:
-                    result.append(from_line) #as is, no copy performed
+                    yield from_line #as is, no copy performed
 
             # We only mangle '---' lines. All others get added straight to
             # the output.
-            result.append(line)
-
-        return result
+            yield line
 
 
     def convert_to_absolute_paths(self, diff_content, repository_info):
@@ -1317,9 +2031,6 @@ class SVNClient(SCMClient):
         This handles paths that have been svn switched to other parts of the
         repository.
         """
-
-        result = []
-
         for line in diff_content:
             front = None
             if line.startswith('+++ ') or line.startswith('--- ') or line.startswith('Index: '):
@@ -1347,12 +2058,51 @@ class SVNClient(SCMClient):
 
                     line = front + " " + path + rest
 
-            result.append(line)
+            yield line
 
-        return result
+    def svn_info_batch(self, paths):
+        """
+        Runs a single "svn info --xml" for several paths and returns the
+        results, keyed by path. Paths that svn can't find are left out, and
+        if the output can't be parsed, nothing is returned, so svn_info will
+        look up the paths one by one.
+        """
+        if not paths:
+            return {}
+
+        debug("Getting svn info for %d paths" % len(paths))
+
+        targets = make_tempfile()
+        f = open(targets, "w")
+        f.write('\n'.join(paths) + '\n')
+        f.close()
+
+        # Missing paths make svn fail and print warnings, which are mixed
+        # into the output.
+        data = execute(["svn", "info", "--xml", "--targets", targets],
+                       ignore_errors=True)
+        os.unlink(targets)
+
+        start = data.find('<?xml')
+        end = data.rfind('</info>')
+        if start < 0 or end < 0:
+            return {}
+
+        handler = SvnInfoHandler()
+        try:
+            xml.sax.parseString(data[start:end + len('</info>')], handler)
+        except xml.sax.SAXException, e:
+            debug("Couldn't parse the svn info output: %s" % e)
+            return {}
+
+        return handler.entries
 
     def svn_info(self, path):
         """Return a dict which is the result of 'svn info' at a given path."""
+        svninfo = self.svn_info_cache.get(path.replace(os.sep, '/'))
+        if svninfo is not None:
+            return svninfo
+
         svninfo = {}
         for info in execute(["svn", "info", path],
                             split_lines=True):
@@ -1361,6 +2111,8 @@ class SVNClient(SCMClient):
                 key, value = parts
                 svninfo[key] = value
 
+        self.svn_info_cache[path.replace(os.sep, '/')] = svninfo
+
         return svninfo
 
     # Adapted from server code parser.py
@@ -1392,18 +2144,19 @@ class PerforceClient(SCMClient):
     A wrapper around the p4 Perforce tool that fetches repository information
     and generates compatible diffs.
     """
+    def __init__(self):
+        SCMClient.__init__(self)
+        self.p4_session = None
+        self.server_address = None
+
     def get_repository_info(self):
         if not check_install('p4 help'):
             return None
 
-        data = self.p4_execute(["p4", "info"], ignore_errors=True)
-
-        m = re.search(r'^Server address: (.+)$', data, re.M)
-        if not m:
+        repository_path = self._get_server_address()
+        if not repository_path:
             return None
 
-        repository_path = m.group(1).strip()
-
         try:
             hostname, port = repository_path.split(":")
             info = socket.gethostbyaddr(hostname)
@@ -1413,6 +2166,22 @@ class PerforceClient(SCMClient):
 
         return RepositoryInfo(path=repository_path, supports_changesets=True)
 
+    def _get_server_address(self):
+        """
+        Returns the address of the Perforce server, as reported by "p4 info",
+        or an empty string if the server can't be reached.
+        """
+        if self.server_address is None:
+            data = self.p4_execute(["p4", "-ztag", "info"], ignore_errors=True)
+
+            m = re.search(r'^\.\.\. serverAddress (.+)$', data, re.M)
+            if not m:
+                return ''
+
+            self.server_address = m.group(1).strip()
+
+        return self.server_address
+
     def scan_for_server(self, repository_info):
         # Scan first for dot files, since it's faster and will cover the
         # user's $HOME/.reviewboardrc
@@ -1481,12 +2250,27 @@ class PerforceClient(SCMClient):
         if options.p4_port:
            os.environ['P4PORT'] = options.p4_port
 
-        description = self.p4_execute(["p4", "describe", "-s", str(changenum)],
-                              split_lines=True)
+        if options.p4_native_diff:
+            # The diffs of submitted changes come along with the description.
+            description = self.p4_execute(["p4", "describe", "-du",
+                                           str(changenum)], split_lines=True)
+        else:
+            description = self.p4_execute(["p4", "describe", "-s",
+                                           str(changenum)], split_lines=True)
 
         if '*pending*' in description[0]:
             cl_is_pending = True
 
+        native_diffs = {}
+        for line_num, line in enumerate(description):
+            if line.startswith('Differences ...'):
+                if not cl_is_pending:
+                    native_diffs = self._parse_native_diffs(
+                        description[line_num + 1:])
+
+                description = description[:line_num]
+                break
+
         # Get the file list
         for line_num, line in enumerate(description):
             if 'Affected files ...' in line:
@@ -1496,18 +2280,10 @@ class PerforceClient(SCMClient):
             # what we were looking for.
             die("Couldn't find any affected files for this change.")
 
-        description = description[line_num + 2:]
-
-        cwd = os.getcwd()
-        diff_lines = []
-
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
-
-        branch = project = None
-        branchdesc = "(none)"
+        # Blank lines are skipped below.
+        description = description[line_num + 1:]
 
+        changes = []
         for line in description:
             line = line.strip()
             if not line:
@@ -1526,170 +2302,489 @@ class PerforceClient(SCMClient):
                 base_revision -= 1
 
             changetype = m.group(3)
+            old_depot_path, new_depot_path = \
+                self._get_depot_revisions(depot_path, base_revision,
+                                          changetype, cl_is_pending)
+
+            changes.append((depot_path, base_revision, changetype,
+                            old_depot_path, new_depot_path))
+
+        branchdesc = self._get_branch_desc([change[0] for change in changes])
+
+        # Opened files that weren't changed don't need to be diffed at all.
+        unmodified_files = set()
+        if cl_is_pending:
+            unmodified_files = self._get_unmodified_files(
+                [change[0] for change in changes
+                 if change[2] in ('edit', 'integrate')])
+
+        if options.p4_native_diff and cl_is_pending:
+            native_diffs = self._diff_opened_files(
+                [change[0] for change in changes
+                 if change[2] in ('edit', 'integrate') and
+                    change[0] not in unmodified_files])
+
+        # Binary and oversized files are never fetched.
+        skipped_files = self._get_skipped_files(
+            [change for change in changes
+             if change[0] not in native_diffs and
+                change[0] not in unmodified_files])
+        skipped_files.update(unmodified_files)
+
+        # Fetch all the depot revisions needed for the diff at once. Files
+        # already diffed by p4 don't need any.
+        file_specs = []
+        for change in changes:
+            if change[0] not in native_diffs and \
+               change[0] not in skipped_files:
+                file_specs += [spec for spec in change[3:] if spec]
 
-            debug('Processing %s of %s' % (changetype, depot_path))
+        depot_files = self._print_files(file_specs)
 
-            local_name = m.group(1)
+        # The new side of a pending change is read from the workspace.
+        local_files = {}
+        if cl_is_pending:
+            local_files = self._depot_to_local(
+                [change[0] for change in changes
+                 if change[0] not in native_diffs and
+                    change[0] not in skipped_files and
+                    change[2] != 'delete'])
 
-            m = re.search('\.\.\. //[^/]+/([^/]+)/([^/]+)/', line)
-            if m:
-                newproject = m.group(1)
-                newbranch = m.group(2)
-                
-                if (not project is None) and newproject != project:
-                    if newbranch != branch:
-                        branchdesc = '(multiple branches)'
-                        break
-                    else:
-                        branchdesc = '%s/(multiple projects)' % branch
-                elif (not branch is None) and newbranch != branch:
-                    branchdesc = '(multiple branches)'
-                    break
-                else:
-                    project = newproject
-                    branch = newbranch
-                    branchdesc = '%s/%s' % (branch, project)
+        def diff_change(change):
+            if change[0] in native_diffs:
+                local_file, hunks = native_diffs[change[0]]
+                return self._native_diff_file(change, local_file, hunks)
+
+            if change[0] in unmodified_files:
+                return self._unmodified_diff_file(change)
+
+            if change[0] in skipped_files:
+                return self._binary_diff_file(change)
+
+            return self._diff_file(change, depot_files, local_files,
+                                   cl_is_pending)
+
+        # The files are diffed concurrently, but parallel_map hands the
+        # results back in depot order.
+        diff_lines = []
+        for dl in parallel_map(diff_change, changes, get_job_count()):
+            diff_lines += dl
+
+        return (''.join(diff_lines), None, branchdesc)
+
+    def _get_depot_revisions(self, depot_path, base_revision, changetype,
+                             cl_is_pending):
+        """
+        Returns the old and new depot revisions that need to be printed in
+        order to diff a file. None stands for the empty file or, for the new
+        side of a pending change, the file in the local workspace.
+        """
+        old_depot_path = new_depot_path = None
 
-            old_file = new_file = empty_filename
-            old_depot_path = new_depot_path = None
-            changetype_short = None
+        if changetype in ('edit', 'integrate', 'delete'):
+            old_depot_path = "%s#%s" % (depot_path, base_revision)
 
+        if not cl_is_pending:
             if changetype == 'edit' or changetype == 'integrate':
                 # A big assumption
-                new_revision = base_revision + 1
+                new_depot_path = "%s#%s" % (depot_path, base_revision + 1)
+            elif changetype == 'add' or changetype == 'branch':
+                new_depot_path = depot_path
 
-                # We have an old file, get p4 to take this old version from the
-                # depot and put it into a plain old temp file for us
-                old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
+        return (old_depot_path, new_depot_path)
 
-                # Also print out the new file into a tmpfile
-                if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
-                else:
-                    new_depot_path = "%s#%s" % (depot_path, new_revision)
-                    self._write_file(new_depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
+    def _diff_opened_files(self, depot_paths):
+        """
+        Diffs the opened files of a pending changelist against their base
+        revisions with a single "p4 diff -du".
+        """
+        if not depot_paths:
+            return {}
 
-                changetype_short = "M"
+        debug("Diffing %d opened files" % len(depot_paths))
 
-            elif changetype == 'add' or changetype == 'branch':
-                # We have a new file, get p4 to put this new file into a pretty
-                # temp file for us. No old file to worry about here.
-                if cl_is_pending:
-                    new_file = self._depot_to_local(depot_path)
-                else:
-                    self._write_file(depot_path, tmp_diff_to_filename)
-                    new_file = tmp_diff_to_filename
-                changetype_short = "A"
-
-            elif changetype == 'delete':
-                # We've deleted a file, get p4 to put the deleted file into  a temp
-                # file for us. The new file remains the empty file.
-                old_depot_path = "%s#%s" % (depot_path, base_revision)
-                self._write_file(old_depot_path, tmp_diff_from_filename)
-                old_file = tmp_diff_from_filename
-                changetype_short = "D"
+        lines = self._p4_execute_with_args(["p4", "diff", "-du"], depot_paths,
+                                           split_lines=True)
+
+        return self._parse_native_diffs(lines)
+
+    def _parse_native_diffs(self, lines):
+        """
+        Returns the local file and the hunks of every file in the unified
+        diffs printed by "p4 describe -du" or "p4 diff -du", keyed by depot
+        path. Files that p4 doesn't diff, such as adds, deletes and binary
+        files, are listed without any hunks and left out.
+        """
+        diffs = {}
+        hunks = None
+        old_count = new_count = 0
+
+        for line in lines:
+            if old_count > 0 or new_count > 0:
+                # Hunk lines are counted, since a removed line starting with
+                # "-- " would otherwise look like the next file header.
+                hunks.append(line)
+                if line.startswith('-'):
+                    old_count -= 1
+                elif line.startswith('+'):
+                    new_count -= 1
+                elif not line.startswith('\\'):
+                    old_count -= 1
+                    new_count -= 1
+                continue
+
+            if hunks is not None:
+                m = re.match(r'@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@', line)
+                if m:
+                    old_count = int(m.group(1) or 1)
+                    new_count = int(m.group(2) or 1)
+                    hunks.append(line)
+                    continue
+
+                if line.startswith('\\'):
+                    # "\ No newline at end of file"
+                    hunks.append(line)
+                    continue
+
+            line = line.rstrip('\r\n')
+
+            # "==== //depot/file#3 (text) ====" in describe, and
+            # "==== //depot/file#3 - /local/file ====" in older versions of
+            # p4 diff.
+            m = re.match(r'==== (.+?)#\d+ (?:\([^)]*\)|- (.+)) ====$', line)
+            if m:
+                hunks = []
+                diffs[m.group(1)] = (m.group(2), hunks)
+                continue
+
+            # "--- //depot/file<TAB>date" and "+++ /local/file<TAB>date" in
+            # newer versions of p4 diff.
+            m = re.match(r'--- (//.+?)(?:#\d+)?(?:\t.*)?$', line)
+            if m:
+                depot_path = m.group(1)
+                hunks = []
+                diffs[depot_path] = (None, hunks)
+                continue
+
+            m = re.match(r'\+\+\+ (.+?)(?:\t.*)?$', line)
+            if m and hunks == []:
+                diffs[depot_path] = (m.group(1), hunks)
+
+        return dict([(depot_path, diff) for depot_path, diff in diffs.items()
+                     if diff[1]])
+
+    def _native_diff_file(self, change, local_file, hunks):
+        """
+        Generates the diff lines for a single file of a changelist from the
+        hunks computed by p4, with the same headers as _diff_file.
+        """
+        depot_path, base_revision = change[:2]
+
+        debug('Using the p4 diff of %s' % depot_path)
+
+        local_path = self._get_local_path(depot_path)
+
+        timestamp = None
+        if local_file and os.path.exists(local_file):
+            timestamp = os.path.getmtime(local_file)
+
+        return ["--- %s\t%s#%s\n" % (local_path, depot_path, base_revision),
+                "+++ %s\t%s\n" % (local_path, format_timestamp(timestamp))] + \
+               hunks
+
+    def _get_unmodified_files(self, depot_paths):
+        """
+        Returns the depot paths of the opened files whose content is the
+        same as their base revision, as reported by a single
+        "p4 -ztag diff -sr".
+        """
+        if not depot_paths:
+            return set()
+
+        records = self._parse_tagged_output(
+            self._p4_execute_with_args(["p4", "-ztag", "diff", "-sr"],
+                                       depot_paths, split_lines=True,
+                                       ignore_errors=True))
+
+        return set([record['depotFile'] for record in records
+                    if 'depotFile' in record])
+
+    def _get_skipped_files(self, changes):
+        """
+        Returns the depot paths of the files that are binary or larger than
+        the --p4-max-file-size limit in any of the revisions needed for the
+        diff. The types and sizes of all revisions are looked up with a
+        single "p4 -ztag fstat -Ol".
+        """
+        file_specs = []
+        for change in changes:
+            file_specs += [spec for spec in change[3:] if spec]
+
+        if not file_specs:
+            return set()
+
+        records = self._parse_tagged_output(
+            self._p4_execute_with_args(["p4", "-ztag", "fstat", "-Ol"],
+                                       file_specs, split_lines=True,
+                                       ignore_errors=True))
+
+        # Each record is stored only under the spec that asked for it: the
+        # revision it describes, or the plain depot path for the head
+        # revision. Otherwise the stats of one revision could be used for
+        # another revision of the same file.
+        requested = set(file_specs)
+        stats = {}
+        for record in records:
+            if 'depotFile' not in record:
+                continue
+
+            spec = "%s#%s" % (record['depotFile'], record.get('headRev'))
+            if spec in requested:
+                stats[spec] = record
+            elif record['depotFile'] in requested and \
+                 record['depotFile'] not in stats:
+                stats[record['depotFile']] = record
+
+        max_size = options.p4_max_file_size * 1024
+
+        skipped_files = set()
+        for change in changes:
+            for spec in change[3:]:
+                record = stats.get(spec)
+                if not spec or not record:
+                    continue
+
+                filetype = record.get('headType', '')
+                size = int(record.get('fileSize', 0))
+
+                if 'binary' in filetype or \
+                   filetype.split('+')[0] in ('apple', 'resource'):
+                    debug("Skipping %s of type %s" % (spec, filetype))
+                    skipped_files.add(change[0])
+                elif max_size > 0 and size > max_size:
+                    print "Warning: %s is too large to be diffed (%d KB)" % \
+                        (spec, size / 1024)
+                    skipped_files.add(change[0])
+
+        return skipped_files
+
+    def _binary_diff_file(self, change):
+        """
+        Generates the diff lines for a file that isn't diffed, in the same
+        form as _diff_file uses for binary files.
+        """
+        depot_path, base_revision, changetype = change[:3]
+
+        local_path = self._get_local_path(depot_path)
+        changetype_short = {'edit': 'M', 'integrate': 'M', 'add': 'A',
+                            'branch': 'A', 'delete': 'D'}[changetype]
+
+        return ["==== %s#%s ==%s== %s ====\n" % \
+                    (depot_path, base_revision, changetype_short, local_path),
+                "Binary files %s#%s and %s differ\n" % \
+                    (depot_path, base_revision, local_path)]
+
+    def _unmodified_diff_file(self, change):
+        """
+        Generates the diff lines for an opened file that wasn't changed, in
+        the same form as _diff_file.
+        """
+        depot_path, base_revision = change[:2]
+
+        local_path = self._get_local_path(depot_path)
+
+        print "Warning: %s in your changeset is unmodified" % local_path
+
+        return ["==== %s#%s ==M== %s ====\n" % \
+                (depot_path, base_revision, local_path)]
+
+    def _get_local_path(self, depot_path):
+        cwd = os.getcwd()
+
+        if depot_path.startswith(cwd):
+            return depot_path[len(cwd) + 1:]
+
+        return depot_path
+
+    def _diff_file(self, change, depot_files, local_files, cl_is_pending):
+        """
+        Generates the diff lines for a single file of a changelist from the
+        depot files fetched by _print_files and, for pending changes, the
+        files in the local workspace found by _depot_to_local.
+        """
+        depot_path, base_revision, changetype, old_depot_path, new_depot_path = \
+            change
+
+        debug('Processing %s of %s' % (changetype, depot_path))
+
+        local_path = self._get_local_path(depot_path)
+
+        old_data = new_data = ""
+        timestamp = None
+        changetype_short = None
+
+        if changetype == 'edit' or changetype == 'integrate':
+            # We have an old file, take this old version from the depot
+            old_data = depot_files[old_depot_path]
+
+            # Also get the new file
+            if cl_is_pending:
+                new_file = local_files[depot_path]
+                new_data = read_text_file(new_file)
+                timestamp = os.path.getmtime(new_file)
             else:
-                die("Unknown change type '%s' for %s" % (changetype, depot_path))
+                new_data = depot_files[new_depot_path]
 
-            diff_cmd = ["rbdiff", "-urNp", old_file, new_file]
-            # Diff returns "1" if differences were found.
-            dl = execute(diff_cmd, extra_ignore_errors=(1, 2)).splitlines(True)
+            changetype_short = "M"
 
-            if local_name.startswith(cwd):
-                local_path = local_name[len(cwd) + 1:]
+        elif changetype == 'add' or changetype == 'branch':
+            # We have a new file. No old file to worry about here.
+            if cl_is_pending:
+                new_file = local_files[depot_path]
+                new_data = read_text_file(new_file)
+                timestamp = os.path.getmtime(new_file)
             else:
-                local_path = local_name
-
-            # Special handling for the output of the diff tool on binary files:
-            #     diff outputs "Files a and b differ"
-            # and the code below expects the outptu to start with
-            #     "Binary files "
-            if len(dl) == 1 and \
-               (dl[0].startswith('Files %s and %s differ' % (old_file, new_file)) or \
-                dl[0].startswith('Files %s and Change differ' % old_file)):
-                dl = ["Binary files %s and %s differ\n" % (old_file, new_file)]
-
-            if dl == [] or dl[0].startswith("Binary files "):
-                if dl == []:
-                    print "Warning: %s in your changeset is unmodified" % \
-                        local_path
-
-                dl.insert(0, "==== %s#%s ==%s== %s ====\n" % \
-                    (depot_path, base_revision, changetype_short, local_path))
+                new_data = depot_files[new_depot_path]
+            changetype_short = "A"
+
+        elif changetype == 'delete':
+            # We've deleted a file, take the deleted file from the depot.
+            # The new file remains empty.
+            old_data = depot_files[old_depot_path]
+            changetype_short = "D"
+        else:
+            die("Unknown change type '%s' for %s" % (changetype, depot_path))
+
+        dl = diff_file_contents(old_data, new_data,
+                                "%s#%s" % (depot_path, base_revision), local_path,
+                                "%s\t%s#%s" % (local_path, depot_path, base_revision),
+                                "%s\t%s" % (local_path, format_timestamp(timestamp)))
+
+        if dl == [] or dl[0].startswith("Binary files "):
+            if dl == []:
+                print "Warning: %s in your changeset is unmodified" % \
+                    local_path
+
+            dl.insert(0, "==== %s#%s ==%s== %s ====\n" % \
+                (depot_path, base_revision, changetype_short, local_path))
+
+        return dl
+
+    def _print_files(self, file_specs):
+        """
+        Returns the contents of several file revisions, keyed by file spec.
+        Specific revisions ("//path#N") never change, so they are taken from
+        the file cache where possible. The rest is fetched with a single
+        "p4 print".
+        """
+        result = {}
+        missing = []
+
+        for spec in file_specs:
+            data = None
+            if file_cache and re.search(r'#\d+$', spec):
+                data = file_cache.get(self._get_cache_key(spec))
+
+            if data is None:
+                missing.append(spec)
             else:
-                m = re.search(r'(\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)', dl[1])
-                if m:
-                    timestamp = m.group(1)
-                else:
-                    # Thu Sep  3 11:24:48 2007
-                    m = re.search(r'(\w+)\s+(\w+)\s+(\d+)\s+(\d\d:\d\d:\d\d)\s+(\d\d\d\d)', dl[1])
-                    if not m:
-                        die("Unable to parse diff header: %s" % dl[1])
-
-                    month_map = {
-                        "Jan": "01",
-                        "Feb": "02",
-                        "Mar": "03",
-                        "Apr": "04",
-                        "May": "05",
-                        "Jun": "06",
-                        "Jul": "07",
-                        "Aug": "08",
-                        "Sep": "09",
-                        "Oct": "10",
-                        "Nov": "11",
-                        "Dec": "12",
-                    }
-                    month = month_map[m.group(2)]
-                    day = m.group(3)
-                    timestamp = m.group(4)
-                    year = m.group(5)
-
-                    timestamp = "%s-%s-%s %s" % (year, month, day, timestamp)
-
-                dl[0] = "--- %s\t%s#%s\n" % (local_path, depot_path, base_revision)
-                dl[1] = "+++ %s\t%s\n" % (local_path, timestamp)
+                result[spec] = data
 
-            diff_lines += dl
+        if result:
+            debug("Found %d depot files in the cache" % len(result))
 
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
+        for spec, data in self._p4_print(missing).items():
+            if file_cache and re.search(r'#\d+$', spec):
+                file_cache.put(self._get_cache_key(spec), data)
 
-        return (''.join(diff_lines), None, branchdesc)
+            result[spec] = data
+
+        return result
+
+    def _get_cache_key(self, file_spec):
+        return "p4:%s:%s" % (self._get_server_address(), file_spec)
 
-    def _write_file(self, depot_path, tmpfile):
+    def _p4_print(self, file_specs):
         """
-        Grabs a file from Perforce and writes it to a temp file. We do this
-        wrather than telling p4 print to write it out in order to work around
-        a permissions bug on Windows.
+        Grabs several file revisions from Perforce with a single
+        "p4 -G print" and returns their contents, keyed by file spec.
         """
-        debug('Writing "%s" to "%s"' % (depot_path, tmpfile))
-        data = self.p4_execute(["p4", "print", "-q", depot_path])
+        if not file_specs:
+            return {}
+
+        debug("Printing %d depot files" % len(file_specs))
+
+        # The marshalled records of -G keep the contents of each file apart
+        # from the fields and from the next file, whatever they contain.
+        records = self._p4_execute_with_args(["p4", "-G", "print"], file_specs,
+                                             marshalled=True,
+                                             ignore_errors=True)
+        result = split_print_records(records, file_specs)
+
+        # Files p4 didn't print, e.g. because of an error, are printed one at
+        # a time, so that the error is reported.
+        for spec in file_specs:
+            if spec not in result:
+                debug("Printing %s separately" % spec)
+                result[spec] = translate_newlines(
+                    self.p4_execute(["p4", "print", "-q", spec], raw=True))
 
-        f = open(tmpfile, "w")
-        f.write(data)
-        f.close()
+        return result
 
-    def _depot_to_local(self, depot_path):
+    def _depot_to_local(self, depot_paths):
+        """
+        Given several paths in the depot, returns a dict mapping each of them
+        to the path of the same file on the local filesystem. All paths are
+        resolved by a single "p4 -ztag where".
         """
-        Given a path in the depot return the path on the local filesystem to
-        the same file.
+        if not depot_paths:
+            return {}
+
+        # $ p4 -ztag where //user/bvanzant/main/testing
+        # ... depotFile //user/bvanzant/main/testing
+        # ... clientFile //bvanzant:test05/home/testing
+        # ... path /home/bvanzant/home-versioned/testing
+        where_output = self._p4_execute_with_args(["p4", "-ztag", "where"],
+                                                  depot_paths, split_lines=True)
+
+        records = self._parse_tagged_output(where_output)
+
+        # If you have a multi-line view mapping with exclusions, Perforce
+        # will display the exclusions in order, flagged with "... unmap",
+        # with the last record showing the actual location.
+        local_files = {}
+        for record in records:
+            if 'depotFile' in record and 'path' in record and \
+               'unmap' not in record:
+                local_files[record['depotFile']] = record['path']
+
+        for depot_path in depot_paths:
+            if depot_path not in local_files:
+                die("Unable to find the local file of %s" % depot_path)
+
+        return local_files
+
+    def _parse_tagged_output(self, lines):
         """
-        # $ p4 where //user/bvanzant/main/testing
-        # //user/bvanzant/main/testing //bvanzant:test05:home/testing /home/bvanzant/home-versioned/testing
-        where_output = self.p4_execute(["p4", "where", depot_path], split_lines=True)
-        # Take only the last line from the where command.  If you have a
-        # multi-line view mapping with exclusions, Perforce will display
-        # the exclusions in order, with the last line showing the actual
-        # location.
-        last_line = where_output[ - 1].strip()
+        Splits the output of a "p4 -ztag" command into one dict of fields
+        per record. A record starts with its "... depotFile" field, or with
+        a field the previous record already has, such as "... change". The
+        lines following a "... desc" field continue the description.
+        """
+        records = []
+        field = None
+        for line in lines:
+            m = re.match(r'\.\.\. (\w+) ?(.*)$', line.rstrip('\r\n'))
+            if m:
+                field = m.group(1)
+                if field == 'depotFile' or not records or \
+                   field in records[-1]:
+                    records.append({})
+                records[-1][field] = m.group(2)
+            elif field == 'desc':
+                records[-1][field] += '\n' + line.rstrip('\r\n')
 
-        # XXX: This breaks on filenames with spaces.
-        return last_line.split(' ')[2].rstrip()
+        return records
 
     def get_open_changes(self, include_submitted):
         # set the P4 enviroment:
@@ -1701,45 +2796,66 @@ class PerforceClient(SCMClient):
 
         user = string.lower(get_scm_user(config, options))
         
-        cmd = ['p4', 'changes', '-L']
+        cmd = ['p4', '-ztag', 'changes', '-L']
         if not include_submitted:
             cmd = cmd + ['-s', 'pending']
         cmd = cmd + ['-m', str(config.ReadInt(constants.CONFIG_SCM_MAX_P4_CL_COUNT, constants.DEFAULT_CONFIG_SCM_MAX_P4_CL_COUNT)), '-u', user]
         
         changes = self.p4_execute(cmd, split_lines = True)
 
-        result = []
-        changeid = None
-        desc = None
+        found = []
+        for record in self._parse_tagged_output(changes):
+            # The lines of the description are joined into a single one.
+            desc = ' '.join([line.strip()
+                             for line in record.get('desc', '').splitlines()
+                             if line.strip()])
 
-        for line in changes:
-            m = re.search(r'Change (\d+)', line)
-            if m:
-                if changeid and desc:
-                    result.append(SCMChange(changeid, desc, self.get_branch(changeid)))
-                    changeid = None
-                    desc = None
-                changeid = m.group(1)
-            else:
-                m = re.search(r'\t(.[^\r\n]+)', line)
-                if m:
-                    if desc:
-                        desc = desc + ' ' + m.group(1)
-                    else:
-                        desc = m.group(1)
+            if 'change' in record and desc:
+                found.append((record['change'], desc))
 
-        if changeid and desc:
-            result.append(SCMChange(changeid, desc, self.get_branch(changeid)))
+        branches = self.get_branches([changeid for changeid, desc in found])
+
+        result = []
+        for changeid, desc in found:
+            result.append(SCMChange(changeid, desc, branches[changeid]))
 
         return result
 
-    def get_branch(self, changeid):
-        changelist = self.p4_execute(['p4', 'describe', '-s', changeid], split_lines = True)
+    def get_branches(self, changeids):
+        """
+        Returns a dict mapping each of the given change numbers to its branch
+        description. All changes are described by a single
+        "p4 -ztag describe -s".
+        """
+        if not changeids:
+            return {}
+
+        description = self.p4_execute(['p4', '-ztag', 'describe', '-s'] +
+                                      changeids, split_lines = True)
+
+        # The files of a change are listed as depotFile0, depotFile1, ...
+        depot_paths = {}
+        for record in self._parse_tagged_output(description):
+            if 'change' in record:
+                paths = depot_paths.setdefault(record['change'], [])
+                while 'depotFile%d' % len(paths) in record:
+                    paths.append(record['depotFile%d' % len(paths)])
+
+        branches = {}
+        for changeid in changeids:
+            branches[changeid] = self._get_branch_desc(depot_paths.get(changeid, []))
 
+        return branches
+
+    def _get_branch_desc(self, depot_paths):
+        """
+        Derives the "branch/project" description from the depot paths of
+        the files of a change.
+        """
         branch = project = None
         branchdesc = "(none)"
-        for ln in changelist:
-            m = re.search('\.\.\. //[^/]+/([^/]+)/([^/]+)/', ln)
+        for depot_path in depot_paths:
+            m = re.match('//[^/]+/([^/]+)/([^/]+)/', depot_path)
             if m:
                 newproject = m.group(1)
                 newbranch = m.group(2)
@@ -1760,10 +2876,66 @@ class PerforceClient(SCMClient):
         
         return branchdesc
 
+    def _get_p4_session(self):
+        """
+        Returns the persistent P4Python session, or None if P4Python isn't
+        installed or the session has been disabled.
+        """
+        if options is None or options.no_p4_session or \
+           not p4session.is_available():
+            return None
+
+        if not self.p4_session:
+            self.p4_session = p4session.P4Session()
+
+        return self.p4_session
+
     def p4_execute(self, command, env=None, split_lines=False, ignore_errors=False,
-                   extra_ignore_errors=()):
+                   extra_ignore_errors=(), raw=False, marshalled=False):
+        """
+        Runs a p4 command over the P4Python session if possible, or with the
+        p4 binary otherwise. With marshalled set, the command is expected to
+        use -G and the list of its records is returned.
+        """
+        session = self._get_p4_session()
+        if session and not env:
+            debug("(p4 session) %s" % subprocess.list2cmdline(command))
+            try:
+                data = session.run(command, raw)
+            except p4session.P4SessionError, e:
+                # Let the p4 binary deal with the failure, including the
+                # login prompt for expired sessions.
+                debug("Falling back to the p4 binary: %s" % e)
+            else:
+                if split_lines and not marshalled:
+                    return data.splitlines(True)
+
+                return data
+
+        if marshalled:
+            return execute_marshalled(command, env=env,
+                                      ignore_errors=ignore_errors)
+
         return execute(command, env=env, split_lines=split_lines, ignore_errors=ignore_errors,
-                         extra_ignore_errors=extra_ignore_errors, p4_login_fix=True)
+                         extra_ignore_errors=extra_ignore_errors, p4_login_fix=True,
+                         raw=raw)
+
+    def _p4_execute_with_args(self, command, args, **kwargs):
+        """
+        Runs a p4 command on a list of arguments, such as file specs, which
+        are passed through an argument file ("p4 -x") to stay clear of command
+        line length limits.
+        """
+        argfile = make_tempfile()
+        f = open(argfile, "w")
+        f.write('\n'.join(args) + '\n')
+        f.close()
+
+        try:
+            return self.p4_execute([command[0], "-x", argfile] + command[1:],
+                                   **kwargs)
+        finally:
+            os.unlink(argfile)
 
 
 """
@@ -1773,7 +2945,8 @@ and generates compatible diffs.
 class DtrClient(DtrBaseClient, SCMClient):
     def __init__(self):
         SCMClient.__init__(self)
-        DtrBaseClient.__init__(self, get_dtr_server(config, options), constants.DTR_USER, constants.DTR_PASSWORD)
+        DtrBaseClient.__init__(self, get_dtr_server(config, options), constants.DTR_USER, constants.DTR_PASSWORD,
+                               file_cache, get_job_count())
 
     def get_repository_info(self):
         return RepositoryInfo(path=get_dtr_server(config, options), supports_changesets=False)
@@ -1832,11 +3005,6 @@ class DtrClient(DtrBaseClient, SCMClient):
         print >> sys.stderr, act
         print >> sys.stderr, "***************************************"
 
-        # create temp files
-        empty_filename = make_tempfile()
-        tmp_diff_from_filename = make_tempfile()
-        tmp_diff_to_filename = make_tempfile()
-
         changes = act.get_version_set() + act.get_content_set();
         for version in changes:
             if type(version) == DtrVersion:
@@ -1867,45 +3035,31 @@ class DtrClient(DtrBaseClient, SCMClient):
                 print >> sys.stderr, 'Skipping %s of %s (is a directory)' % (changetype, depot_path)
             else:
                 print >> sys.stderr, 'Processing %s of %s' % (changetype, depot_path)
-                old_file = new_file = empty_filename
-
-                old_depot_path = new_depot_path = None
+                old_data = new_data = ""
                 changetype_short = None
 
                 if version.is_created():
-                    # We have a new file, get p4 to put this new file into a pretty
-                    # temp file for us. No old file to worry about here.
-                    new_file = tmp_diff_to_filename
-                    self._dtr_get_file(act, version, new_file, False)
+                    # We have a new file. No old file to worry about here.
+                    new_data = self._dtr_get_file(act, version, False)
                     changetype_short = "A"
                 elif version.is_deleted():
-                    # We've deleted a file, get p4 to put the deleted file into  a temp
-                    # file for us. The new file remains the empty file.
-                    old_file = tmp_diff_from_filename
-                    self._dtr_get_file(act, version, old_file, True)
+                    # We've deleted a file, get the deleted file from DTR.
+                    # The new file remains empty.
+                    old_data = self._dtr_get_file(act, version, True)
                     changetype_short = "D"
                 else: # Edit
                     # get predecessor
-                    old_file = tmp_diff_from_filename
-                    self._dtr_get_file(act, version, old_file, True)
-                    # Also print out the new file into a tmpfile
-                    new_file = tmp_diff_to_filename
-                    self._dtr_get_file(act, version, new_file, False)
+                    old_data = self._dtr_get_file(act, version, True)
+                    # Also get the new file
+                    new_data = self._dtr_get_file(act, version, False)
                     changetype_short = "M"
 
-                diff_cmd = ["rbdiff", "-urNp", old_file, new_file]
-                # Diff returns "1" if differences were found.
-                dl = execute(diff_cmd, extra_ignore_errors=(1, 2)).splitlines(True)
-
                 local_path = version.get_name()
 
-                # Special handling for the output of the diff tool on binary files:
-                #     diff outputs "Files a and b differ"
-                # and the code below expects the outptu to start with
-                #     "Binary files "
-                if len(dl) == 1 and \
-                   dl[0].startswith('Files %s and %s differ' % (old_file, new_file)):
-                    dl = ["Binary files %s and %s differ\n" % (old_file, new_file)]
+                dl = diff_file_contents(old_data, new_data,
+                                        "%s#%s" % (depot_path, base_revision), local_path,
+                                        "%s\t%s#%s" % (local_path, depot_path, base_revision),
+                                        "%s\t%s" % (local_path, format_timestamp()))
 
                 if dl == [] or dl[0].startswith("Binary files "):
                     if dl == []:
@@ -1914,47 +3068,10 @@ class DtrClient(DtrBaseClient, SCMClient):
 
                     dl.insert(0, "==== %s#%s ==%s== %s ====\n" % \
                         (depot_path, base_revision, changetype_short, local_path))
-                else:
-                    m = re.search(r'(\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)', dl[1])
-                    if m:
-                        timestamp = m.group(1)
-                    else:
-                        # Thu Sep  3 11:24:48 2007
-                        m = re.search(r'(\w+)\s+(\w+)\s+(\d+)\s+(\d\d:\d\d:\d\d)\s+(\d\d\d\d)', dl[1])
-                        if not m:
-                            die("Unable to parse diff header: %s" % dl[1])
-
-                        month_map = {
-                            "Jan": "01",
-                            "Feb": "02",
-                            "Mar": "03",
-                            "Apr": "04",
-                            "May": "05",
-                            "Jun": "06",
-                            "Jul": "07",
-                            "Aug": "08",
-                            "Sep": "09",
-                            "Oct": "10",
-                            "Nov": "11",
-                            "Dec": "12",
-                        }
-                        month = month_map[m.group(2)]
-                        day = m.group(3)
-                        timestamp = m.group(4)
-                        year = m.group(5)
-
-                        timestamp = "%s-%s-%s %s" % (year, month, day, timestamp)
-
-                    dl[0] = "--- %s\t%s#%s\n" % (local_path, depot_path, base_revision)
-                    dl[1] = "+++ %s\t%s\n" % (local_path, timestamp)
 
                 diff_lines += "Index: %s\n===================================================================\n" % version.path
                 diff_lines += dl
 
-        os.unlink(empty_filename)
-        os.unlink(tmp_diff_from_filename)
-        os.unlink(tmp_diff_to_filename)
-
         return (''.join(diff_lines), None, branchdesc)
         
     def get_open_changes(self, include_submitted):
@@ -2270,6 +3387,26 @@ def debug(s):
         print ">>> %s" % s
 
 
+def get_job_count():
+    """
+    Returns the number of SCM operations that may run concurrently.
+    """
+    if options is None or options.no_mt:
+        return 1
+
+    return max(1, options.jobs)
+
+
+def read_text_file(filename):
+    """
+    Reads a local text file, translating its line endings to "\\n".
+    """
+    f = open(filename, "rU")
+    data = f.read()
+    f.close()
+    return data
+
+
 def make_tempfile():
     """
     Creates a temporary file and returns the path. The path is stored
@@ -2281,6 +3418,33 @@ def make_tempfile():
     return tmpfile
 
 
+def diff_file_contents(old_data, new_data, old_name, new_name, old_label,
+                       new_label):
+    """
+    Diffs the contents of two files in-process, falling back to rbdiff
+    for the changes that are too expensive to diff that way.
+    """
+    try:
+        return diff_buffers(old_data, new_data, old_name, new_name,
+                            old_label, new_label, max_cost=DIFF_MAX_COST)
+    except DiffTooExpensive:
+        debug("Diffing %s with rbdiff" % new_name)
+
+    old_file = make_tempfile()
+    new_file = make_tempfile()
+
+    for filename, data in ((old_file, old_data), (new_file, new_data)):
+        f = open(filename, "wb")
+        f.write(data)
+        f.close()
+
+    # Binary and identical files never get here, so diff only ever exits
+    # with 1 for "differences found".
+    return split_lines(execute(["rbdiff", "-u", "-p", "-L", old_label,
+                                "-L", new_label, old_file, new_file],
+                               extra_ignore_errors=(1,), raw=True))
+
+
 def check_install(command):
     """
     Try executing an external command and return a boolean indicating whether
@@ -2363,20 +3527,16 @@ def tempt_fate(server, tool, changenum, diff_content=None,
         else:
             review_request = server.new_review_request(changenum, submit_as)
 
+        fields = []
+
         if options.target_groups:
-            server.set_review_request_field(review_request, 'target_groups',
-                                            options.target_groups)
-            save_draft = True
+            fields.append(('target_groups', options.target_groups))
 
         if options.target_people:
-            server.set_review_request_field(review_request, 'target_people',
-                                            options.target_people)
-            save_draft = True
+            fields.append(('target_people', options.target_people))
 
         if options.summary:
-            server.set_review_request_field(review_request, 'summary',
-                                            options.summary)
-            save_draft = True
+            fields.append(('summary', options.summary))
 
         if branch:
             bid = branch
@@ -2385,24 +3545,20 @@ def tempt_fate(server, tool, changenum, diff_content=None,
         else:
             bid = None
         if bid:
-            server.set_review_request_field(review_request, 'branch',
-                                            bid)
-            save_draft = True
+            fields.append(('branch', bid))
 
         if options.bugs_closed:
-            server.set_review_request_field(review_request, 'bugs_closed',
-                                            options.bugs_closed)
-            save_draft = True
+            fields.append(('bugs_closed', options.bugs_closed))
 
         # do not overwrite description if this is an update
         if options.description and not rid:
-            server.set_review_request_field(review_request, 'description',
-                                            options.description)
-            save_draft = True
+            fields.append(('description', options.description))
 
         if options.testing_done:
-            server.set_review_request_field(review_request, 'testing_done',
-                                            options.testing_done)
+            fields.append(('testing_done', options.testing_done))
+
+        if fields:
+            server.set_review_request_fields(review_request, fields)
             save_draft = True
 
         # do not save draft if this is an update
@@ -2411,10 +3567,10 @@ def tempt_fate(server, tool, changenum, diff_content=None,
     except APIError, e:
         rsp, = e.args
         if rsp['err']['code'] == 103: # Not logged in
+            server.clear_session_cookie()
             server.login()
-            tempt_fate(server, tool, changenum, diff_content,
-                       parent_diff_content, submit_as, review_id, branch)
-            return
+            return tempt_fate(server, tool, changenum, diff_content,
+                              parent_diff_content, submit_as, review_id, branch)
 
         if options.rid:
             die("Error getting review request %s: %s (code %s)\nDetails (not for the faint-hearted): %s" % \
@@ -2470,6 +3626,15 @@ def parse_options(args):
                       dest="open_browser", action="store_true",
                       default=OPEN_BROWSER,
                       help="open a web browser to the review request page")
+    parser.add_option("--compress-diff",
+                      dest="compress_diff", action="store_true",
+                      default=COMPRESS_DIFF,
+                      help="upload diffs gzip compressed, if the server "
+                           "accepts compressed request bodies")
+    parser.add_option("--compress-threshold",
+                      dest="compress_threshold", type="int",
+                      default=COMPRESS_THRESHOLD, metavar="KB",
+                      help="only compress diffs of at least this size")
     parser.add_option("-n", "--output-diff",
                       dest="output_diff_only", action="store_true",
                       default=False,
@@ -2557,6 +3722,21 @@ def parse_options(args):
     parser.add_option("--p4-port",
                       dest="p4_port", default=None,
                       help="the Perforce servers IP address that the review is on")
+    parser.add_option("--no-p4-session",
+                      dest="no_p4_session", action="store_true", default=False,
+                      help="run every Perforce command through the p4 binary "
+                           "instead of a persistent P4Python session, which "
+                           "is only used for commands with tagged output")
+    parser.add_option("--p4-native-diff",
+                      dest="p4_native_diff", action="store_true",
+                      default=P4_NATIVE_DIFF,
+                      help="let the Perforce server diff the text files of "
+                           "the changelist")
+    parser.add_option("--p4-max-file-size",
+                      dest="p4_max_file_size", type="int",
+                      default=P4_MAX_FILE_SIZE, metavar="KB",
+                      help="don't diff Perforce files larger than this "
+                           "(0 for no limit)")
     parser.add_option("--repository-url",
                       dest="repository_url", default=None,
                       help="the url for a repository for creating a diff "
@@ -2571,6 +3751,17 @@ def parse_options(args):
     parser.add_option("--scmuser",
                       dest="scmuser", default=None,
                       help="overrides the default SCM user")
+    parser.add_option("--cache-size",
+                      dest="cache_size", type="int", default=CACHE_SIZE,
+                      metavar="MB",
+                      help="maximum size of the depot file cache in megabytes")
+    parser.add_option("--no-cache",
+                      dest="no_cache", action="store_true", default=False,
+                      help="don't cache depot files, labels and server "
+                           "information")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs", type="int", default=JOBS, metavar="N",
+                      help="number of files to fetch and diff concurrently")
     parser.add_option("--no-mt",
                       dest="no_mt", action="store_true", default=False,
                       help="disables multithreading (for debugging only)")
@@ -3034,17 +4225,23 @@ def post_review(tool, repository_info, cookie_file, args, review_id):
             sys.exit(0)
 
         # Let's begin.
-        server.login()
+        try:
+            server.login()
 
-        (review_url, id) = tempt_fate(server, tool, changenum, diff_content=diff,
-                                parent_diff_content=parent_diff,
-                                submit_as=options.submit_as, review_id = review_id,
-                                branch = branch)
+            (review_url, id) = tempt_fate(server, tool, changenum, diff_content=diff,
+                                    parent_diff_content=parent_diff,
+                                    submit_as=options.submit_as, review_id = review_id,
+                                    branch = branch)
+        finally:
+            server.save_cookies()
 
         # store review submission history
         if len(args) > 0:
             config.WriteInt(constants.CONFIG_REVIEW_HISTORY_PREFIX % args[0], int(id))
 
+        pool = keepalive.connection_pool
+        debug("HTTP connections: %d opened, %d reused" % (pool.opened, pool.reused))
+
         # Load the review up in the browser if requested to:
         if options.open_browser:
             try:
@@ -3086,6 +4283,22 @@ def main(args):
     cookie_file = os.path.join(homepath, ".post-review-cookies.txt")
 
     args = parse_options(args)
+
+    if not options.no_cache:
+        if options.cache_size > 0:
+            globals()['file_cache'] = \
+                FileCache(os.path.join(homepath, ".post-review-cache", "files"),
+                          options.cache_size * 1024 * 1024)
+
+        globals()['repository_cache'] = \
+            JsonCache(os.path.join(homepath, ".post-review-cache",
+                                   "repositories.json"),
+                      REPOSITORY_CACHE_TTL)
+
+        globals()['label_cache'] = \
+            JsonCache(os.path.join(homepath, ".post-review-cache",
+                                   "labels.json"),
+                      LABEL_CACHE_TTL)
     
     if options.gui:
         app = wx.PySimpleApp()
@@ -0,0 +1,250 @@
+'''
+On-disk caches: one for file contents that never change once they exist,
+such as submitted Perforce revisions or DTR versions of an integration, and
+one for small pieces of server information that are expensive to look up.
+'''
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    # Support Python versions before 2.5.
+    from sha import new as sha1
+
+
+class FileCache(object):
+    """
+    Stores file contents under a key, e.g. a depot path and revision. The
+    least recently used entries are evicted once the cache grows beyond
+    max_size bytes. Any I/O error is treated as a cache miss, since the
+    contents can always be fetched again.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the contents stored under the key, or None.
+        """
+        filename = self._get_filename(key)
+
+        try:
+            f = open(filename, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+
+            # The modification time records the last use.
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+
+        return data
+
+    def put(self, key, data):
+        """
+        Stores the contents under the key, evicting old entries if needed.
+        """
+        if len(data) > self.max_size:
+            return
+
+        filename = self._get_filename(key)
+
+        try:
+            dirname = os.path.dirname(filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            # Write to a temporary file first, so that concurrent readers
+            # never see a partially written entry.
+            fd, tmpfile = tempfile.mkstemp(dir=dirname)
+        except (IOError, OSError):
+            return
+
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+
+            if os.path.exists(filename):
+                os.unlink(tmpfile)
+                return
+
+            os.rename(tmpfile, filename)
+        except (IOError, OSError):
+            # Don't leave the partially written file behind.
+            try:
+                os.remove(tmpfile)
+            except OSError:
+                pass
+
+            return
+
+        self.lock.acquire()
+        try:
+            if self.size is None:
+                self.size = sum([size for mtime, size, path in
+                                 self._get_entries()])
+            else:
+                self.size += len(data)
+
+            if self.size > self.max_size:
+                self._evict()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache is back
+        down to three quarters of its maximum size, so that eviction doesn't
+        happen on every insert.
+        """
+        entries = self._get_entries()
+        entries.sort()
+
+        self.size = sum([size for mtime, size, path in entries])
+        target = self.max_size * 3 / 4
+
+        for mtime, size, path in entries:
+            if self.size <= target:
+                break
+
+            try:
+                os.unlink(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def _get_entries(self):
+        """
+        Returns a (mtime, size, path) tuple for every cache entry.
+        """
+        entries = []
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+
+        return entries
+
+    def _get_filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        digest = sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+
+class JsonCache(object):
+    """
+    Stores JSON serializable values in a single file. Entries expire ttl
+    seconds after they were stored. Like FileCache, an unreadable or
+    unwritable file just means that nothing is cached.
+    """
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value stored under the key, or None if there is none or
+        it expired.
+        """
+        self.lock.acquire()
+        try:
+            self._load()
+            entry = self.entries.get(key)
+        finally:
+            self.lock.release()
+
+        if entry and time.time() - entry[0] < self.ttl:
+            return entry[1]
+
+        return None
+
+    def put(self, key, value):
+        """
+        Stores the value under the key and writes the cache file, dropping
+        any expired entries.
+        """
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            # The value would keep the cache file from ever being written.
+            return
+
+        self.lock.acquire()
+        try:
+            self._load()
+
+            now = time.time()
+            for k, entry in self.entries.items():
+                if now - entry[0] >= self.ttl:
+                    del self.entries[k]
+
+            self.entries[key] = [now, value]
+            self._save()
+        finally:
+            self.lock.release()
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        try:
+            f = open(self.filename, "r")
+            try:
+                self.entries = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        try:
+            dirname = os.path.dirname(self.filename)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            fd, tmpfile = tempfile.mkstemp(dir=dirname)
+        except (IOError, OSError):
+            return
+
+        try:
+            f = os.fdopen(fd, "w")
+            try:
+                json.dump(self.entries, f)
+            finally:
+                f.close()
+
+            try:
+                os.rename(tmpfile, self.filename)
+            except OSError:
+                # Windows doesn't replace existing files on rename.
+                os.remove(self.filename)
+                os.rename(tmpfile, self.filename)
+        except (IOError, OSError, TypeError, ValueError):
+            # Don't leave the partially written file behind.
+            try:
+                os.remove(tmpfile)
+            except OSError:
+                pass
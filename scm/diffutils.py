@@ -0,0 +1,556 @@
+'''
+An in-process unified diff engine producing output in the format of
+"diff -urNp" for two in-memory buffers.
+
+The lines of both buffers are hashed to integers and compared using the
+linear space variant of Myers' O(ND) algorithm. Hunks are grouped like GNU
+diff does and carry the nearest preceding "function" line (-p).
+
+Like GNU diff without --minimal, the search for the shortest edit script
+is cut short where the two ranges are too different, so huge rewrites get
+a longer script than the minimal one instead of taking quadratic time.
+Where several minimal scripts exist, the one picked isn't necessarily the
+one GNU diff picks either, so for a small share of inputs the hunks differ
+from those of diff while describing the same change. benchmark_diff.py
+reports how often that happens on real files.
+
+Being pure Python, the engine is much slower than diff on big, heavily
+changed files. Callers can pass a max_cost to diff_buffers to find out
+about those and hand them to diff instead.
+'''
+
+import re
+import time
+
+# Lines GNU diff considers to be the start of a function for -p.
+FUNCTION_RE = re.compile(r'[A-Za-z$_]')
+
+# Maximum length of the function name shown in a hunk header.
+FUNCTION_MAX_LEN = 40
+
+NO_NEWLINE = "\\ No newline at end of file\n"
+
+
+class DiffTooExpensive(Exception):
+    """
+    Raised when diffing two buffers would take more work than max_cost.
+    """
+    pass
+
+
+def is_binary(data):
+    """
+    Returns True if the data looks like the content of a binary file.
+    """
+    return '\0' in data
+
+
+def split_lines(data):
+    """
+    Splits data into lines, keeping the line endings. Unlike
+    str.splitlines, only "\\n" ends a line, just like in diff.
+    """
+    lines = [line + "\n" for line in data.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+
+    return lines
+
+
+def format_timestamp(timestamp = None):
+    """
+    Formats a timestamp (defaulting to now) the way diff headers need it.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def diff_buffers(old_data, new_data, old_name, new_name, old_label = None,
+                 new_label = None, context = 3, show_function = True,
+                 max_cost = None):
+    """
+    Diffs two buffers and returns the lines of the unified diff. The result
+    is empty if the buffers are identical and consists of a single
+    "Binary files ... differ" line for binary content. The labels are
+    written after "--- " and "+++ " and default to the names.
+
+    max_cost limits the number of diagonals the search may visit, counted
+    over all of its rounds. DiffTooExpensive is raised once it's exceeded.
+    """
+    if old_data == new_data:
+        return []
+
+    if is_binary(old_data) or is_binary(new_data):
+        return ["Binary files %s and %s differ\n" % (old_name, new_name)]
+
+    if old_label is None:
+        old_label = old_name
+    if new_label is None:
+        new_label = new_name
+
+    old_lines = split_lines(old_data)
+    new_lines = split_lines(new_data)
+
+    result = ["--- %s\n" % old_label, "+++ %s\n" % new_label]
+    result += unified_hunks(old_lines, new_lines, context, show_function,
+                            max_cost)
+
+    return result
+
+
+def unified_hunks(old_lines, new_lines, context = 3, show_function = True,
+                  max_cost = None):
+    """
+    Returns the hunks of a unified diff between two lists of lines.
+    """
+    result = []
+    last_search = 0
+    last_function = None
+    opcodes = get_opcodes(old_lines, new_lines, max_cost)
+
+    for group in _group_opcodes(opcodes, context):
+        i1 = group[0][1]
+        i2 = group[-1][2]
+        j1 = group[0][3]
+        j2 = group[-1][4]
+
+        header = "@@ -%s +%s @@" % (_format_range(i1, i2), _format_range(j1, j2))
+
+        if show_function:
+            # Look for a function line between the previous hunk and this
+            # one, falling back to the one found for an earlier hunk.
+            for i in xrange(i1 - 1, last_search - 1, -1):
+                if FUNCTION_RE.match(old_lines[i]):
+                    last_function = old_lines[i]
+                    break
+            last_search = i1
+
+            if last_function is not None:
+                header += " " + _format_function(last_function)
+
+        result.append(header + "\n")
+
+        for tag, a1, a2, b1, b2 in group:
+            if tag == 'equal':
+                _append_lines(result, " ", old_lines, a1, a2)
+                continue
+
+            if tag == 'replace' or tag == 'delete':
+                _append_lines(result, "-", old_lines, a1, a2)
+
+            if tag == 'replace' or tag == 'insert':
+                _append_lines(result, "+", new_lines, b1, b2)
+
+    return result
+
+
+def get_opcodes(old_lines, new_lines, max_cost = None):
+    """
+    Returns a list of (tag, i1, i2, j1, j2) tuples describing how to turn
+    old_lines into new_lines, using the same tags as difflib.
+    """
+    a, b = _hash_lines(old_lines, new_lines)
+    n = len(a)
+    m = len(b)
+
+    # Flag the changed lines of both files. The extra False entry at the end
+    # doubles as the sentinel before the first line (index -1).
+    changed_a = [True] * n + [False]
+    changed_b = [True] * m + [False]
+    for i, j, size in _matching_blocks(a, b, max_cost):
+        changed_a[i:i + size] = [False] * size
+        changed_b[j:j + size] = [False] * size
+
+    _shift_boundaries(a, changed_a, changed_b)
+    _shift_boundaries(b, changed_b, changed_a)
+
+    opcodes = []
+    i = j = 0
+    while i < n or j < m:
+        i1 = i
+        j1 = j
+        while i < n and j < m and not changed_a[i] and not changed_b[j]:
+            i += 1
+            j += 1
+
+        if i > i1:
+            opcodes.append(('equal', i1, i, j1, j))
+            continue
+
+        while changed_a[i]:
+            i += 1
+        while changed_b[j]:
+            j += 1
+
+        if i > i1 and j > j1:
+            opcodes.append(('replace', i1, i, j1, j))
+        elif i > i1:
+            opcodes.append(('delete', i1, i, j1, j))
+        else:
+            opcodes.append(('insert', i1, i, j1, j))
+
+    return opcodes
+
+
+def get_matching_blocks(old_lines, new_lines):
+    """
+    Returns a list of (i, j, size) triples of matching lines, terminated by
+    a (len(old_lines), len(new_lines), 0) sentinel.
+    """
+    a, b = _hash_lines(old_lines, new_lines)
+
+    return _matching_blocks(a, b) + [(len(a), len(b), 0)]
+
+
+def _hash_lines(old_lines, new_lines):
+    """
+    Maps the lines to small integers, which are cheaper to compare.
+    """
+    hashes = {}
+    a = [hashes.setdefault(line, len(hashes)) for line in old_lines]
+    b = [hashes.setdefault(line, len(hashes)) for line in new_lines]
+
+    return (a, b)
+
+
+def _matching_blocks(a, b, max_cost = None):
+    """
+    Returns the (i, j, size) triples of matching lines between two lists of
+    line hashes.
+    """
+    # Lines that only occur in one of the files can never match, so they are
+    # left out of the comparison. This makes rewritten files cheap to diff.
+    in_a = set(a)
+    in_b = set(b)
+    a_map = [i for i in xrange(len(a)) if a[i] in in_b]
+    b_map = [j for j in xrange(len(b)) if b[j] in in_a]
+
+    blocks = []
+    for i, j, size in _myers_blocks([a[i] for i in a_map],
+                                    [b[j] for j in b_map], max_cost):
+        for k in xrange(size):
+            x = a_map[i + k]
+            y = b_map[j + k]
+            if blocks and blocks[-1][0] + blocks[-1][2] == x and \
+               blocks[-1][1] + blocks[-1][2] == y:
+                blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + 1)
+            else:
+                blocks.append((x, y, 1))
+
+    return blocks
+
+
+def _myers_blocks(a, b, max_cost = None):
+    """
+    Returns the matching blocks of a short edit script between two lists
+    of line hashes, sorted but not necessarily merged.
+    """
+    n = len(a)
+    m = len(b)
+    blocks = []
+
+    # The number of diagonals visited so far, shared by all bisections.
+    cost = [0]
+
+    # The ranges still to compare are kept on a stack, together with the
+    # common suffixes that have to be emitted once the range before them is
+    # done. Processing them in stack order keeps the blocks sorted.
+    stack = [(0, n, 0, m)]
+    while stack:
+        item = stack.pop()
+        if item[0] is None:
+            blocks.append(item[1:])
+            continue
+
+        a_lo, a_hi, b_lo, b_hi = item
+
+        # Common prefix and suffix lines never need to go through Myers.
+        prefix = 0
+        while a_lo + prefix < a_hi and b_lo + prefix < b_hi and \
+              a[a_lo + prefix] == b[b_lo + prefix]:
+            prefix += 1
+
+        if prefix:
+            blocks.append((a_lo, b_lo, prefix))
+            a_lo += prefix
+            b_lo += prefix
+
+        suffix = 0
+        while a_lo < a_hi - suffix and b_lo < b_hi - suffix and \
+              a[a_hi - suffix - 1] == b[b_hi - suffix - 1]:
+            suffix += 1
+
+        a_hi -= suffix
+        b_hi -= suffix
+
+        if suffix:
+            stack.append((None, a_hi, b_hi, suffix))
+
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+
+        split = _bisect(a, a_lo, a_hi, b, b_lo, b_hi, cost, max_cost)
+        if split:
+            x, y = split
+            stack.append((x, a_hi, y, b_hi))
+            stack.append((a_lo, x, b_lo, y))
+
+    return blocks
+
+
+def _bisect(a, a_lo, a_hi, b, b_lo, b_hi, cost, max_cost):
+    """
+    Finds the point where the forward and backward searches for the
+    shortest edit script between a[a_lo:a_hi] and b[b_lo:b_hi] meet and
+    returns it as absolute (x, y) coordinates, or None if the ranges have
+    nothing in common. The ranges must not share a common prefix or suffix.
+
+    Like GNU diff, this gives up on finding the minimal script when the
+    ranges are too different and splits at the furthest reaching forward
+    path instead, which keeps huge rewrites from taking quadratic time.
+
+    The diagonals visited are added to cost[0], and DiffTooExpensive is
+    raised once that goes over max_cost.
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    front = delta % 2 != 0
+    max_d = (n + m + 1) // 2
+    offset = max_d
+    length = 2 * max_d + 2
+    too_expensive = max(256, int((n + m) ** 0.5) * 4)
+
+    v1 = [-1] * length
+    v2 = [-1] * length
+    v1[offset + 1] = 0
+    v2[offset + 1] = 0
+
+    # Diagonals that ran off the edit graph are skipped in later rounds.
+    k1start = k1end = k2start = k2end = 0
+
+    for d in xrange(max_d):
+        # Walk the forward path from the top left corner.
+        for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+
+            while x1 < n and y1 < m and a[a_lo + x1] == b[b_lo + y1]:
+                x1 += 1
+                y1 += 1
+
+            v1[k1_offset] = x1
+
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < length and v2[k2_offset] != -1 and \
+                   x1 >= n - v2[k2_offset]:
+                    return (a_lo + x1, b_lo + y1)
+
+        # Walk the reverse path from the bottom right corner.
+        for k2 in xrange(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+
+            while x2 < n and y2 < m and \
+                  a[a_hi - x2 - 1] == b[b_hi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+
+            v2[k2_offset] = x2
+
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return (a_lo + x1, b_lo + y1)
+
+        cost[0] += 2 * d + 2
+        if max_cost is not None and cost[0] > max_cost:
+            raise DiffTooExpensive()
+
+        if d >= too_expensive:
+            best = 0
+            for k1 in xrange(-d + k1start, d + 1 - k1end, 2):
+                x1 = v1[offset + k1]
+                y1 = x1 - k1
+                if 0 <= x1 <= n and 0 <= y1 <= m and x1 + y1 > best and \
+                   (x1, y1) != (n, m):
+                    best = x1 + y1
+                    split = (a_lo + x1, b_lo + y1)
+
+            if best:
+                return split
+
+    return None
+
+
+def _shift_boundaries(equivs, changed, other_changed):
+    """
+    Slides runs of changed lines as far down as possible, merging them with
+    following runs, and then back up to line up with a run of changes in
+    the other file. This is how GNU diff picks among equally short scripts,
+    e.g. which of several identical lines gets deleted.
+    """
+    i = j = 0
+    i_end = len(equivs)
+
+    while True:
+        # Scan forward to the beginning of the next run of changes, keeping
+        # track of the corresponding point in the other file.
+        while i < i_end and not changed[i]:
+            while other_changed[j]:
+                j += 1
+            j += 1
+            i += 1
+
+        if i == i_end:
+            break
+
+        start = i
+
+        # Find the end of this run of changes.
+        i += 1
+        while changed[i]:
+            i += 1
+        while other_changed[j]:
+            j += 1
+
+        while True:
+            runlength = i - start
+
+            # Move the run up while the previous unchanged line matches the
+            # last changed one, merging it with previous runs.
+            while start and equivs[start - 1] == equivs[i - 1]:
+                start -= 1
+                changed[start] = True
+                i -= 1
+                changed[i] = False
+                while changed[start - 1]:
+                    start -= 1
+                j -= 1
+                while other_changed[j]:
+                    j -= 1
+
+            if other_changed[j - 1]:
+                corresponding = i
+            else:
+                corresponding = i_end
+
+            # Move the run down while the first changed line matches the
+            # following unchanged one, merging it with following runs.
+            while i != i_end and equivs[start] == equivs[i]:
+                changed[start] = False
+                start += 1
+                changed[i] = True
+                i += 1
+                while changed[i]:
+                    i += 1
+                j += 1
+                while other_changed[j]:
+                    corresponding = i
+                    j += 1
+
+            if runlength == i - start:
+                break
+
+        # Move the fully merged run back to a corresponding run in the
+        # other file, if possible.
+        while corresponding < i:
+            start -= 1
+            changed[start] = True
+            i -= 1
+            changed[i] = False
+            j -= 1
+            while other_changed[j]:
+                j -= 1
+
+
+def _group_opcodes(opcodes, context):
+    """
+    Groups opcodes into hunks with up to context lines of context. Changes
+    separated by no more than twice the context are merged into one hunk.
+    """
+    if not opcodes:
+        return []
+
+    opcodes = list(opcodes)
+
+    # Trim the leading and trailing context.
+    if opcodes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    if opcodes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            groups.append(group)
+            group = []
+            i1 = i2 - context
+            j1 = j2 - context
+        group.append((tag, i1, i2, j1, j2))
+
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+
+    return groups
+
+
+def _format_range(start, stop):
+    """
+    Formats a hunk range the way GNU diff does.
+    """
+    length = stop - start
+
+    if length == 1:
+        return "%d" % (start + 1)
+
+    if length == 0:
+        # An empty range refers to the line before it.
+        return "%d,0" % start
+
+    return "%d,%d" % (start + 1, length)
+
+
+def _format_function(line):
+    """
+    Trims a function line for display in a hunk header.
+    """
+    line = line.rstrip("\r\n").lstrip()[:FUNCTION_MAX_LEN]
+
+    return line.rstrip()
+
+
+def _append_lines(result, prefix, lines, start, stop):
+    for i in xrange(start, stop):
+        line = lines[i]
+        if line.endswith("\n"):
+            result.append(prefix + line)
+        else:
+            result.append(prefix + line + "\n" + NO_NEWLINE)
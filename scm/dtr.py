@@ -14,11 +14,14 @@ import httplib
 import rfc822
 import os
 import re
+import socket
 import string
 import sys
+import threading
 import time
 import xml.sax
 import xml.sax.handler
+from scm.pool import parallel_map
 
 class DtrBaseObject(object):
     def __init__(self, resource_path):
@@ -260,23 +263,50 @@ class DtrBaseClient(object):
         self.user = "anzeiger"
         self.password = "display"
 
-    def __init__(self, server, user, password):
-        self.conn = None
+    def __init__(self, server, user, password, cache = None, max_workers = 1):
+        # idle keep-alive connections, shared by the worker threads
+        self.conns = []
+        self.conns_lock = threading.Lock()
         self.server = server
         self.user = user
         self.password = password
+        # optional FileCache for the immutable versions of integrations
+        self.cache = cache
+        # number of resources fetched concurrently
+        self.max_workers = max_workers
 
     def __del__(self):
         self._disconnect()
 
     def _connect(self):
-        if self.conn == None:
-            self.conn = httplib.HTTPConnection(self.server)
+        """
+        Returns an idle connection or a new one, along with whether the
+        connection is being reused.
+        """
+        self.conns_lock.acquire()
+        try:
+            if self.conns:
+                return self.conns.pop(), True
+        finally:
+            self.conns_lock.release()
+
+        return httplib.HTTPConnection(self.server), False
+
+    def _release(self, conn):
+        self.conns_lock.acquire()
+        try:
+            self.conns.append(conn)
+        finally:
+            self.conns_lock.release()
 
     def _disconnect(self):
-        if self.conn != None:
-            self.conn.close()
-            self.conn = None
+        self.conns_lock.acquire()
+        try:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+        finally:
+            self.conns_lock.release()
 
     class DtrBaseHandler(xml.sax.handler.ContentHandler, object):
         STATE_INIT = 0
@@ -697,71 +727,174 @@ class DtrBaseClient(object):
             self.buffer = ""
 
 
-    def _dtr_request(self, method, path, payload = '', recursive = False):
+    class DtrExpandPropertyHandler(DtrBaseHandler):
+        """
+        Parses the result of an expand-property REPORT, in which the hrefs of
+        the expanded properties are replaced by complete DAV:response
+        elements. The outermost response is passed on to the root handler,
+        every nested response to a handler of its own, created by the
+        factory. The parent handler is handed a plain DAV:href instead of the
+        nested response, so the existing handlers can be used unchanged.
+        """
+        def __init__(self, root, factory):
+            super(self.__class__, self).__init__()
+            self.root = root
+            self.factory = factory
+            # href -> handler of each nested response
+            self.handlers = {}
+            # handler, element level and href of the responses being parsed
+            self.stack = []
+            self.level = 0
+            self.href_level = None
+
+        def _current(self):
+            if self.stack:
+                return self.stack[-1][0]
+            return self.root
+
+        def startElement(self, name, attributes):
+            self.level += 1
+            if name == "DAV:response":
+                if self.stack:
+                    self.stack.append([self.factory(), self.level, None])
+                else:
+                    self.stack.append([self.root, self.level, None])
+            elif name == "DAV:href" and self.stack and self.stack[-1][2] is None and self.level == self.stack[-1][1] + 1:
+                # the href of the response itself
+                self.href_level = self.level
+                self.buffer = ""
+            else:
+                self._current().startElement(name, attributes)
+
+        def characters(self, data):
+            if self.href_level is None:
+                self._current().characters(data)
+            else:
+                self.buffer += data
+
+        def endElement(self, name):
+            if self.href_level == self.level:
+                self.href_level = None
+                self.stack[-1][2] = self.buffer
+                if len(self.stack) > 1:
+                    handler = self.stack[-1][0]
+                    # a version set member takes precedence over the same
+                    # version showing up as a predecessor, since only the
+                    # members have their predecessors expanded
+                    if self.buffer not in self.handlers or len(self.stack) == 2:
+                        self.handlers[self.buffer] = handler
+
+                    parent = self.stack[-2][0]
+                    parent.startElement("DAV:href", {})
+                    parent.buffer = self.buffer
+                    parent.endElement("DAV:href")
+                self.buffer = ""
+            elif name == "DAV:response" and self.stack and self.stack[-1][1] == self.level:
+                self.stack.pop()
+            else:
+                self._current().endElement(name)
+            self.level -= 1
+
+
+    # resource types known to _dtr_make_resource
+    RESOURCE_TYPES = ("version", "working_resource", "file", "collection")
+
+    XCM_NAMESPACE = "http://xml.sap.com/2002/12/dtr/xcm"
+
+    # properties read by DtrFileVersionWorkingResourceHandler
+    RESOURCE_PROPERTIES = '<property name="displayname"/>\n<property name="getlastmodified"/>\n<property name="resourcetype"/>\n<property name="sequence-number" namespace="%(xcm)s"/>\n<property name="path" namespace="%(xcm)s"/>\n<property name="deleted" namespace="%(xcm)s"/>\n<property name="resource-type" namespace="%(xcm)s"/>\n' % {'xcm': XCM_NAMESPACE}
+
+    # expands the version set and content set of an activity, along with the
+    # predecessors (or base versions) of their members
+    EXPAND_ACTIVITY_REQUEST = '<?xml version="1.0" encoding="utf-8"?>\n<expand-property xmlns="DAV:">\n<property name="version-set" namespace="%(xcm)s">\n%(resource)s%(predecessors)s</property>\n<property name="activity-content-set" namespace="%(xcm)s">\n%(resource)s%(predecessors)s</property>\n</expand-property>' % {
+        'xcm': XCM_NAMESPACE,
+        'resource': RESOURCE_PROPERTIES,
+        'predecessors': '<property name="predecessor-set">\n%(resource)s</property>\n<property name="base-version" namespace="%(xcm)s">\n%(resource)s</property>\n' % {'xcm': XCM_NAMESPACE, 'resource': RESOURCE_PROPERTIES},
+    }
+
+    def _dtr_request(self, method, path, payload = ''):
         # "Basic" authentication encodes userid:password in base64. Note
         # that base64.encodestring adds some extra newlines/carriage-returns
         # to the end of the result. string.strip is a simple way to remove
         # these characters.
         auth = 'Basic ' + string.strip(base64.encodestring(self.user + ':' + self.password))
 
-        self._connect()
+        while True:
+            conn, reused = self._connect()
+
+            try:
+                # get activity details
+                conn.putrequest(method, path, False, True)
+                conn.putheader("Authorization", auth)
+                conn.putheader("Depth", "0")
+                if payload and len(payload) > 0:
+                    conn.putheader("Content-Type", 'application/xml; charset="utf-8"')
+                    conn.putheader("Content-Length", len(payload))
+                conn.endheaders()
+                conn.send(payload)
+                resp = conn.getresponse()
+            except (httplib.BadStatusLine, socket.error):
+                # the server closed an idle keep-alive connection before
+                # responding. After an idle period all pooled connections
+                # are likely closed, so they are dropped and the request
+                # (which only reads from DTR) is sent over a new connection.
+                conn.close()
+                if not reused:
+                    raise
+                self._disconnect()
+                continue
+            except:
+                conn.close()
+                raise
+
+            break
 
         try:
-            # get activity details
-            self.conn.putrequest(method, path, False, True)
-            self.conn.putheader("Authorization", auth)
-            self.conn.putheader("Depth", "0")
-            if payload and len(payload) > 0:
-                self.conn.putheader("Content-Type", 'application/xml; charset="utf-8"')
-                self.conn.putheader("Content-Length", len(payload))
-            self.conn.endheaders()
-            self.conn.send(payload)
-            resp = self.conn.getresponse()
+            # the response has to be read completely before the connection
+            # can be reused
+            data = resp.read()
             if resp.status < httplib.OK or resp.status >= httplib.MULTIPLE_CHOICES :
                 raise httplib.HTTPException("Received bad response from %s: %s %s" % (self.server, resp.status, resp.reason))
-        except httplib.BadStatusLine:
-            self._disconnect()
-            if recursive:
-                raise
-            else:
-                return self._dtr_request(method, path, payload, True)
         except:
-            self._disconnect()
+            conn.close()
             raise
-        
-        return resp
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+
+        return data
 
     def _dtr_get_integration(self, integration):
-        resp = self._dtr_request("PROPFIND", integration)
+        xmldata = self._dtr_request("PROPFIND", integration)
         handler = self.DtrIntegrationHandler()
-        xml.sax.parseString(resp.read(), handler)
+        xml.sax.parseString(xmldata, handler)
         #if handler.creationdate is None or handler.creationdate == "":
         #    print xmlstr
         return DtrIntegration(integration, handler.workspace, handler.creationdate, handler.isn)
     
     def dtr_get_activity(self, activity):
-        resp = self._dtr_request("PROPFIND", activity)
+        xmldata = self._dtr_request("PROPFIND", activity)
         handler = self.DtrActivityHandler()
-        xmldata = resp.read()
         # print xmldata
         xml.sax.parseString(xmldata, handler)
 
         act = DtrActivity(activity, handler.displayname, handler.version_set_state, handler.client_id, handler.originator)
     
         print >> sys.stderr, "Integrations: %s" % handler.integrations
-        for integration in handler.integrations:
-            print >> sys.stderr, "Fetching integration: %s" % integration
-            act._add_integration(self._dtr_get_integration(integration))
+        for integration in parallel_map(self._dtr_get_integration, handler.integrations, self.max_workers):
+            act._add_integration(integration)
 
         print >> sys.stderr, "Versions: %s" % handler.version_set
-        for version in handler.version_set:
-            print >> sys.stderr, "Fetching version: %s" % version
-            act._add_version(self._dtr_get_resource(version))
-
         print >> sys.stderr, "Content Set: %s" % handler.content_set
-        for resource in handler.content_set:
-            print >> sys.stderr, "Fetching resource: %s" % resource
-            act._add_content(self._dtr_get_resource(resource))
+        resources = self._dtr_get_activity_resources(activity, handler.version_set + handler.content_set)
+
+        for version in resources[:len(handler.version_set)]:
+            act._add_version(version)
+
+        for resource in resources[len(handler.version_set):]:
+            act._add_content(resource)
 
         if act.integrations:
             act.workspace_name = act.get_oldest_integration().workspace
@@ -773,42 +906,123 @@ class DtrBaseClient(object):
         
         return act
 
+    def _dtr_get_activity_resources(self, activity, resources):
+        """
+        Fetches the version set and content set members of an activity,
+        along with their predecessors, using a single expand-property REPORT.
+        Anything missing from the report, e.g. because the server doesn't
+        support it, is fetched resource by resource.
+        """
+        expanded = {}
+        if resources:
+            try:
+                xmldata = self._dtr_request("REPORT", activity, self.EXPAND_ACTIVITY_REQUEST)
+                handler = self.DtrExpandPropertyHandler(self.DtrActivityHandler(), self.DtrFileVersionWorkingResourceHandler)
+                xml.sax.parseString(xmldata, handler)
+                expanded = handler.handlers
+            except (httplib.HTTPException, xml.sax.SAXException), e:
+                print >> sys.stderr, "Unable to expand the activity properties: %s" % e
+
+        found = {}
+        missing = []
+        for resource in resources:
+            handler = expanded.get(resource)
+            if handler is None or handler.resource_type not in self.RESOURCE_TYPES:
+                missing.append(resource)
+                continue
+
+            predecessors = []
+            for predecessor in self._get_predecessor_paths(handler):
+                if predecessor not in expanded or expanded[predecessor].resource_type not in self.RESOURCE_TYPES:
+                    break
+                predecessors.append(self._dtr_make_resource(predecessor, expanded[predecessor], []))
+            else:
+                found[resource] = self._dtr_make_resource(resource, handler, predecessors)
+                continue
+
+            missing.append(resource)
+
+        if missing:
+            print >> sys.stderr, "Fetching %d of %d resources individually" % (len(missing), len(resources))
+            for resource, result in zip(missing, self._dtr_get_resources(missing)):
+                found[resource] = result
+
+        return [found[resource] for resource in resources]
+
+    def _dtr_get_resources(self, resources):
+        """
+        Fetches several resources along with their predecessors, running up
+        to max_workers requests at a time. The resources are returned in the
+        order they were given.
+        """
+        def fetch(resource):
+            print >> sys.stderr, "Fetching resource: %s" % resource
+            return self._dtr_get_properties(resource)
+
+        handlers = parallel_map(fetch, resources, self.max_workers)
+
+        # fetch the predecessors of all resources in a second round
+        predecessor_paths = []
+        for handler in handlers:
+            predecessor_paths += self._get_predecessor_paths(handler)
+
+        predecessors = parallel_map(lambda path: self._dtr_get_resource(path, False),
+                                    predecessor_paths, self.max_workers)
+
+        result = []
+        pos = 0
+        for resource, handler in zip(resources, handlers):
+            count = len(self._get_predecessor_paths(handler))
+            result.append(self._dtr_make_resource(resource, handler, predecessors[pos:pos + count]))
+            pos += count
+
+        return result
+
     def _dtr_get_resource(self, resource, recursive=True):
-        resp = self._dtr_request("PROPFIND", resource)
+        handler = self._dtr_get_properties(resource)
+        predecessors = []
+
+        if recursive:
+            for predecessor in self._get_predecessor_paths(handler):
+                print >> sys.stderr, "Obtaining predecessor: %s" % predecessor
+                predecessors.append(self._dtr_get_resource(predecessor, False))
+
+        return self._dtr_make_resource(resource, handler, predecessors)
+
+    def _dtr_get_properties(self, resource):
+        xmldata = self._dtr_request("PROPFIND", resource)
         handler = self.DtrFileVersionWorkingResourceHandler()
-        xmldata = resp.read()
         # print xmldata
         xml.sax.parseString(xmldata, handler)
+        handler.xmldata = xmldata
+        return handler
 
+    def _get_predecessor_paths(self, handler):
+        # the base version stands in for missing predecessors
         if handler.resource_type == "version" or handler.resource_type == "working_resource":
-            predecessors = []
-
-            if recursive:
-                if len(handler.predecessors) > 0:
-                    for predecessor in handler.predecessors:
-                        print >> sys.stderr, "Obtaining predecessor: %s" % predecessor
-                        predecessors.append(self._dtr_get_resource(predecessor, False))
-                else:
-                    if handler.base_version:
-                        print >> sys.stderr, "Obtaining base version: %s" % handler.base_version
-                        predecessors.append(self._dtr_get_resource(handler.base_version, False))
-
-            if handler.resource_type == "version":
-                return DtrVersion(resource, handler.name, handler.path, handler.revision, handler.deleted, handler.timestamp, predecessors, handler.directory)
-            else:
-                return DtrWorkingResource(resource, handler.name, handler.path, handler.revision, handler.deleted, handler.timestamp, predecessors, handler.directory)
+            if len(handler.predecessors) > 0:
+                return handler.predecessors
+            elif handler.base_version:
+                return [handler.base_version]
+
+        return []
+
+    def _dtr_make_resource(self, resource, handler, predecessors):
+        if handler.resource_type == "version":
+            return DtrVersion(resource, handler.name, handler.path, handler.revision, handler.deleted, handler.timestamp, predecessors, handler.directory)
+        elif handler.resource_type == "working_resource":
+            return DtrWorkingResource(resource, handler.name, handler.path, handler.revision, handler.deleted, handler.timestamp, predecessors, handler.directory)
         elif handler.resource_type == "file":
             return DtrFile(resource, handler.name, handler.path, handler.directory)
         elif handler.resource_type == "collection":
             return DtrCollection(resource, handler.name, handler.path)
         else:
-            print xmldata
+            print handler.xmldata
             raise Exception("Unknown resource type: %s" % handler.resource_type)
 
     def _dtr_get_workspace(self, workspace):
-        resp = self._dtr_request("PROPFIND", workspace)
+        xmldata = self._dtr_request("PROPFIND", workspace)
         handler = self.DtrWorkspaceHandler()
-        xmldata = resp.read()
         xml.sax.parseString(xmldata, handler)
         return DtrWorkspace(handler.path, handler.history)
 
@@ -828,26 +1042,24 @@ class DtrBaseClient(object):
             whereclause += '<XCM:integration-date><XCM:from>%s</XCM:from></XCM:integration-date>' % (datetime.datetime.now() - datetime.timedelta(max_age)).strftime('%a, %d %b %Y %H:%M:%S GMT')
         
         req = request % whereclause
-        resp = self._dtr_request("REPORT", '/dtr/', req)
+        data = self._dtr_request("REPORT", '/dtr/', req)
         handler = self.DtrEnumActivitiesHandler()
-        data = resp.read()
         xml.sax.parseString(data, handler)
         #print data
         return handler.activities
         
 
-    def _dtr_get_file(self, activity, resource, tmpfile, predecessor):
+    def _dtr_get_file(self, activity, resource, predecessor):
         if type(resource) == DtrVersion:
             isn = activity.get_oldest_integration().get_isn()
             if predecessor:
                 isn = isn - 1
-            resp = self._dtr_request("GET", "%s/byintegration/all/%s%s" % (activity.get_workspace().get_history(), isn, resource.get_path()))
-            data = resp.read()
+            path = "%s/byintegration/all/%s%s" % (activity.get_workspace().get_history(), isn, resource.get_path())
+            data = self._dtr_get_version(path)
         else:
             if predecessor:
                 # predecessor is stored in DTR for open activities
-                resp = self._dtr_request("GET", resource.get_most_recent_predecessor().get_resource_path())
-                data = resp.read()
+                data = self._dtr_request("GET", resource.get_most_recent_predecessor().get_resource_path())
             else:
                 # check whether this is the correct machine
                 if activity.get_client_hostname().lower() != os.environ["COMPUTERNAME"].lower():
@@ -858,9 +1070,22 @@ class DtrBaseClient(object):
                 data = i.read()
                 i.close()
 
-        f = open(tmpfile, "w+")
-        f.write(self._convert_line_ending(data))
-        f.close()
+        return self._convert_line_ending(data)
+
+    def _dtr_get_version(self, path):
+        # versions of an integration never change, so they can be cached
+        key = "dtr:%s:%s" % (self.server, path)
+        if self.cache:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+
+        data = self._dtr_request("GET", path)
+
+        if self.cache:
+            self.cache.put(key, data)
+
+        return data
 
     def _convert_line_ending(self, data):
         result = re.sub('(\r\n)', '\n', data)
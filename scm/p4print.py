@@ -0,0 +1,74 @@
+'''
+Reading of "p4 -G" output, in which every record is a marshalled Python
+dict. "p4 -G print" writes a "stat" record with the tagged fields of each
+file, followed by the file contents in "text" or "binary" records, so the
+contents never have to be told apart from the fields.
+'''
+
+import marshal
+
+
+def read_records(f):
+    """
+    Reads the marshalled records from a file, such as the stdout of a
+    "p4 -G" process, until its end.
+    """
+    records = []
+
+    while True:
+        try:
+            records.append(marshal.load(f))
+        except EOFError:
+            break
+
+    return records
+
+
+def split_print_records(records, file_specs):
+    """
+    Returns the contents of the files in the records of "p4 -G print", keyed
+    by the file spec each of them was printed for. Files that weren't
+    printed, e.g. because of an error, are left out.
+    """
+    files = {}
+    chunks = None
+
+    for record in records:
+        code = record.get('code')
+
+        if code == 'stat':
+            spec = "%s#%s" % (record.get('depotFile'), record.get('rev'))
+            if spec not in file_specs:
+                spec = record.get('depotFile')
+
+            if spec in file_specs and spec not in files:
+                # An empty file has no content records at all.
+                chunks = []
+                files[spec] = chunks
+            else:
+                chunks = None
+        elif code in ('text', 'binary'):
+            if chunks is not None:
+                chunks.append((code, record.get('data', '')))
+        else:
+            chunks = None
+
+    result = {}
+    for spec, chunks in files.items():
+        data = ''.join([data for code, data in chunks])
+
+        # Text files are printed with the line endings of the client.
+        if chunks and chunks[0][0] == 'text':
+            data = translate_newlines(data)
+
+        result[spec] = data
+
+    return result
+
+
+def translate_newlines(data):
+    """
+    Translates the line endings of printed file contents to "\\n", just like
+    the universal newline mode used for the output of other commands.
+    """
+    return data.replace('\r\n', '\n').replace('\r', '\n')
@@ -0,0 +1,223 @@
+'''
+A persistent Perforce session on top of P4Python. Commands run over a single
+authenticated connection instead of spawning a new p4 process each time, and
+their output is formatted the way the p4 binary would print it, or returned
+as the records "p4 -G" would marshal, so callers can parse it the same way.
+'''
+
+import os
+import threading
+
+try:
+    import P4
+except ImportError:
+    P4 = None
+
+
+def is_available():
+    """
+    Returns whether P4Python is installed.
+    """
+    return P4 is not None
+
+
+class P4SessionError(Exception):
+    """
+    Raised when a command can't be run over the session. The caller is
+    expected to fall back to the p4 binary.
+    """
+    pass
+
+
+class P4Session(object):
+    def __init__(self):
+        self._p4 = None
+        self._settings = None
+        self._lock = threading.Lock()
+
+    def run(self, command, raw=False):
+        """
+        Runs a p4 command line, given as a list starting with "p4", and
+        returns its output as text. With raw set, the output is returned
+        without the warnings and without translating its line endings.
+        Commands given -G return a list of records instead.
+        """
+        args, tagged, marshalled = self._parse_command(command)
+
+        self._lock.acquire()
+        try:
+            p4 = self._connect()
+            p4.tagged = tagged
+
+            try:
+                results = p4.run(*args)
+            except P4.P4Exception:
+                raise P4SessionError('\n'.join(p4.errors) or
+                                     "Failed to run p4 %s" % args[0])
+
+            warnings = p4.warnings
+        finally:
+            self._lock.release()
+
+        if marshalled:
+            return self._marshal(args[0], results, warnings)
+
+        data = self._format(args[0], results)
+        if raw:
+            return data
+
+        if warnings:
+            data += '\n'.join(warnings) + '\n'
+
+        # Match the universal newline translation of execute().
+        return data.replace('\r\n', '\n').replace('\r', '\n')
+
+    def _connect(self):
+        """
+        Returns a connection for the current P4PORT and P4CLIENT settings,
+        which PerforceClient may change between commands.
+        """
+        settings = (os.environ.get('P4PORT'), os.environ.get('P4CLIENT'))
+
+        if self._p4 and (settings != self._settings or
+                         not self._p4.connected()):
+            if self._p4.connected():
+                self._p4.disconnect()
+            self._p4 = None
+
+        if not self._p4:
+            p4 = P4.P4()
+            port, client = settings
+            if port:
+                p4.port = port
+            if client:
+                p4.client = client
+
+            # Warnings (such as "no such file(s)") are returned along with
+            # the output, just like the p4 binary prints them.
+            p4.exception_level = 1
+            p4.prog = 'post-review'
+
+            try:
+                p4.connect()
+            except P4.P4Exception:
+                raise P4SessionError('\n'.join(p4.errors) or
+                                     "Unable to connect to Perforce")
+
+            self._p4 = p4
+            self._settings = settings
+
+        return self._p4
+
+    def _parse_command(self, command):
+        """
+        Splits a p4 command line into the command arguments, whether tagged
+        output was requested and whether it is to be marshalled (-G).
+        Arguments passed through "-x" files are appended to the command
+        arguments. Only commands with tagged output are supported.
+        """
+        args = list(command[1:])
+        tagged = False
+        marshalled = False
+        extra_args = []
+
+        while args and args[0].startswith('-'):
+            opt = args.pop(0)
+            if opt == '-ztag':
+                tagged = True
+            elif opt == '-G':
+                tagged = True
+                marshalled = True
+            elif opt == '-x' and args:
+                f = open(args.pop(0), 'r')
+                extra_args += [line.rstrip('\r\n') for line in f
+                               if line.strip()]
+                f.close()
+            else:
+                raise P4SessionError("Unsupported global option %s" % opt)
+
+        if not args:
+            raise P4SessionError("No p4 command given")
+
+        if not tagged:
+            # The p4 binary formats untagged output itself, e.g. prefixing
+            # the file lines of "p4 describe" with "... ", while P4Python
+            # only returns the bare messages.
+            raise P4SessionError("Untagged output is only available from "
+                                 "the p4 binary")
+
+        return args + extra_args, tagged, marshalled
+
+    def _format(self, cmd, results):
+        """
+        Formats the P4Python results like the p4 binary prints them.
+        """
+        lines = []
+
+        for result in results:
+            if isinstance(result, dict):
+                # The depot path comes first, as it starts every record.
+                keys = sorted(result.keys())
+                if 'depotFile' in result:
+                    keys.remove('depotFile')
+                    keys.insert(0, 'depotFile')
+
+                for key in keys:
+                    value = result[key]
+                    if isinstance(value, list):
+                        for i, item in enumerate(value):
+                            lines.append("... %s%d %s\n" %
+                                         (key, i, self._to_str(item)))
+                    else:
+                        lines.append("... %s %s\n" %
+                                     (key, self._to_str(value)))
+
+                lines.append("\n")
+            elif cmd == 'print':
+                # File contents, which may be split into several chunks.
+                lines.append(self._to_str(result))
+            else:
+                lines.append(self._to_str(result) + "\n")
+
+        return ''.join(lines)
+
+    def _marshal(self, cmd, results, warnings):
+        """
+        Turns the P4Python results into the records "p4 -G" writes: the
+        tagged fields as "stat" records, the contents printed by "p4 print"
+        as "text" or "binary" records, and the warnings as "error" records.
+        """
+        records = []
+        code = 'info'
+
+        for result in results:
+            if isinstance(result, dict):
+                record = {'code': 'stat'}
+                for key, value in result.items():
+                    if isinstance(value, list):
+                        for i, item in enumerate(value):
+                            record["%s%d" % (key, i)] = self._to_str(item)
+                    else:
+                        record[key] = self._to_str(value)
+
+                records.append(record)
+
+                if cmd == 'print':
+                    if 'binary' in record.get('type', ''):
+                        code = 'binary'
+                    else:
+                        code = 'text'
+            else:
+                records.append({'code': code, 'data': self._to_str(result)})
+
+        for warning in warnings:
+            records.append({'code': 'error', 'severity': 2,
+                            'data': self._to_str(warning) + '\n'})
+
+        return records
+
+    def _to_str(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+
+        return str(value)
@@ -0,0 +1,56 @@
+'''
+A small bounded worker pool for running independent SCM operations
+concurrently.
+'''
+
+import Queue
+import sys
+import threading
+
+def parallel_map(func, items, max_workers = 1):
+    """
+    Applies func to each of the items using at most max_workers threads and
+    returns the results in the order of the items. If a worker fails, no new
+    items are started and the first error (including the SystemExit raised by
+    die()) is re-raised in the calling thread.
+    """
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+
+    for entry in enumerate(items):
+        queue.put(entry)
+
+    def worker():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[index] = func(item)
+            except BaseException:
+                errors.append(sys.exc_info())
+                return
+
+    threads = []
+    for i in range(min(max_workers, len(items))):
+        thread = threading.Thread(target = worker, name = "SCM worker %d" % i)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+
+    return results
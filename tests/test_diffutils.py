@@ -0,0 +1,223 @@
+'''
+Tests for scm.diffutils. The expected diffs are the output of GNU diff 3.8
+with "diff -u -p -L old -L new".
+
+    python -m unittest discover -s tests
+'''
+
+import os
+import random
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scm import diffutils
+
+
+HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+FUNCTION_OLD = ('static int x;\n'
+                '\n'
+                'int main(void)\n'
+                '{\n'
+                '    int a = 1;\n'
+                '    int b = 2;\n'
+                '    int c = 3;\n'
+                '    int d = 4;\n'
+                '    return a;\n'
+                '}\n')
+
+
+def apply_patch(old_data, diff_lines):
+    """
+    Applies a unified diff to old_data and returns the result, checking
+    that every context and removed line matches.
+    """
+    old = diffutils.split_lines(old_data)
+    new = []
+    pos = 0
+    # A "\\ No newline" marker comes in one piece with the line before it.
+    lines = diffutils.split_lines(''.join(diff_lines))[2:]
+    i = 0
+
+    while i < len(lines):
+        m = HUNK_RE.match(lines[i])
+        assert m, lines[i]
+        start = int(m.group(1))
+        if m.group(2) != '0':
+            # An empty range is given as the line before it.
+            start -= 1
+
+        assert start >= pos
+        new += old[pos:start]
+        pos = start
+        i += 1
+
+        while i < len(lines) and not lines[i].startswith('@@'):
+            tag = lines[i][0]
+            text = lines[i][1:]
+            i += 1
+
+            if i < len(lines) and lines[i] == diffutils.NO_NEWLINE:
+                text = text[:-1]
+                i += 1
+
+            if tag in ' -':
+                assert old[pos] == text, (old[pos], text)
+                pos += 1
+
+            if tag in ' +':
+                new.append(text)
+
+    return ''.join(new + old[pos:])
+
+
+def random_file(r, count):
+    # Few distinct lines, so that there are many equally short scripts.
+    return ''.join([r.choice(['a\n', 'b\n', 'c\n', '}\n', '\n', 'f()\n'])
+                    for i in xrange(count)])
+
+
+def random_edit(r, data, count):
+    lines = diffutils.split_lines(data)
+    for i in xrange(count):
+        pos = r.randint(0, len(lines))
+        op = r.random()
+        if op < 0.4 and pos < len(lines):
+            del lines[pos]
+        elif op < 0.7 and pos < len(lines):
+            lines[pos] = 'changed %d\n' % i
+        else:
+            lines.insert(pos, r.choice(['a\n', 'b\n', 'new\n']))
+
+    return ''.join(lines)
+
+
+class DiffUtilsTests(unittest.TestCase):
+    def _diff(self, old_data, new_data, **kwargs):
+        """
+        Diffs two buffers and checks that the diff turns the old one into
+        the new one.
+        """
+        dl = diffutils.diff_buffers(old_data, new_data, 'old', 'new',
+                                    **kwargs)
+        self.assertEqual(apply_patch(old_data, dl), new_data)
+        return ''.join(dl)
+
+    def test_no_newline(self):
+        """Testing diff_buffers with no newline at the end of the files"""
+        self.assertEqual(self._diff('a\nb\nc', 'a\nb\nd'),
+                         '--- old\n'
+                         '+++ new\n'
+                         '@@ -1,3 +1,3 @@\n'
+                         ' a\n'
+                         ' b\n'
+                         '-c\n'
+                         '\\ No newline at end of file\n'
+                         '+d\n'
+                         '\\ No newline at end of file\n')
+
+    def test_newline_added(self):
+        """Testing diff_buffers with a newline added at the end"""
+        self.assertEqual(self._diff('a\nb', 'a\nb\n'),
+                         '--- old\n'
+                         '+++ new\n'
+                         '@@ -1,2 +1,2 @@\n'
+                         ' a\n'
+                         '-b\n'
+                         '\\ No newline at end of file\n'
+                         '+b\n')
+
+    def test_empty_file(self):
+        """Testing diff_buffers with an empty file"""
+        self.assertEqual(self._diff('', 'one\ntwo\n'),
+                         '--- old\n'
+                         '+++ new\n'
+                         '@@ -0,0 +1,2 @@\n'
+                         '+one\n'
+                         '+two\n')
+        self.assertEqual(self._diff('one\ntwo\n', ''),
+                         '--- old\n'
+                         '+++ new\n'
+                         '@@ -1,2 +0,0 @@\n'
+                         '-one\n'
+                         '-two\n')
+
+    def test_function(self):
+        """Testing diff_buffers with the function of a hunk (-p)"""
+        new_data = FUNCTION_OLD.replace('return a;', 'return a + b;')
+        self.assertEqual(self._diff(FUNCTION_OLD, new_data),
+                         '--- old\n'
+                         '+++ new\n'
+                         '@@ -6,5 +6,5 @@ int main(void)\n'
+                         '     int b = 2;\n'
+                         '     int c = 3;\n'
+                         '     int d = 4;\n'
+                         '-    return a;\n'
+                         '+    return a + b;\n'
+                         ' }\n')
+
+    def test_hunk_merging(self):
+        """Testing diff_buffers merges hunks with overlapping context"""
+        old_data = ''.join(['%d\n' % i for i in xrange(1, 31)])
+        new_data = old_data.replace('\n5\n', '\nfive\n') \
+                           .replace('\n11\n', '\neleven\n') \
+                           .replace('\n25\n', '\ntwentyfive\n')
+        self.assertEqual(self._diff(old_data, new_data),
+                         '--- old\n'
+                         '+++ new\n'
+                         '@@ -2,13 +2,13 @@\n'
+                         ' 2\n 3\n 4\n'
+                         '-5\n'
+                         '+five\n'
+                         ' 6\n 7\n 8\n 9\n 10\n'
+                         '-11\n'
+                         '+eleven\n'
+                         ' 12\n 13\n 14\n'
+                         '@@ -22,7 +22,7 @@\n'
+                         ' 22\n 23\n 24\n'
+                         '-25\n'
+                         '+twentyfive\n'
+                         ' 26\n 27\n 28\n')
+
+    def test_identical_and_binary(self):
+        """Testing diff_buffers with identical and binary files"""
+        self.assertEqual(diffutils.diff_buffers('a\n', 'a\n', 'old', 'new'),
+                         [])
+        self.assertEqual(diffutils.diff_buffers('GIF\0', 'GIF\0\0',
+                                                'old', 'new'),
+                         ['Binary files old and new differ\n'])
+
+    def test_random_edits(self):
+        """Testing diff_buffers patches apply to random edits"""
+        r = random.Random(1)
+        for i in xrange(200):
+            old_data = random_file(r, r.randint(0, 60))
+            new_data = random_edit(r, old_data, r.randint(1, 10))
+            if r.random() < 0.2:
+                new_data = new_data.rstrip('\n')
+
+            self._diff(old_data, new_data, context=r.randint(0, 4))
+
+    def test_rewrite(self):
+        """Testing diff_buffers with a rewrite too expensive to minimize"""
+        r = random.Random(2)
+        old_data = random_file(r, 1500)
+        new_data = random_file(r, 1500)
+        self._diff(old_data, new_data)
+
+    def test_max_cost(self):
+        """Testing diff_buffers raises DiffTooExpensive above max_cost"""
+        r = random.Random(3)
+        old_data = random_file(r, 300)
+        new_data = random_edit(r, old_data, 100)
+
+        self.assertRaises(diffutils.DiffTooExpensive, diffutils.diff_buffers,
+                          old_data, new_data, 'old', 'new', max_cost=100)
+        self._diff(old_data, new_data, max_cost=1000000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+'''
+Tests for scm.p4print, run against "p4 -G print" output built from the
+records p4 writes, so that no Perforce server is needed.
+
+    python -m unittest discover -s tests
+'''
+
+import marshal
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scm import p4print
+
+
+def stat(depot_file, rev, filetype='text', size=0):
+    return {'code': 'stat', 'depotFile': depot_file, 'rev': str(rev),
+            'change': '12', 'action': 'edit', 'type': filetype,
+            'time': '1262304000', 'fileSize': str(size)}
+
+
+def text(data):
+    return {'code': 'text', 'data': data}
+
+
+def binary(data):
+    return {'code': 'binary', 'data': data}
+
+
+class P4PrintTests(unittest.TestCase):
+    def _print(self, records, file_specs):
+        """
+        Writes the records the way "p4 -G print" does, reads them back and
+        splits them into files.
+        """
+        f = tempfile.TemporaryFile()
+        try:
+            for record in records:
+                marshal.dump(record, f, 0)
+
+            f.seek(0)
+            read = p4print.read_records(f)
+        finally:
+            f.close()
+
+        self.assertEqual(read, records)
+
+        return p4print.split_print_records(read, file_specs)
+
+    def test_blank_separator(self):
+        """Testing p4 -G print with a file ending in a blank line"""
+        files = self._print([stat('//depot/a.c', 2), text('int a;\n\n'),
+                             stat('//depot/b.c', 3), text('int b;\n')],
+                            ['//depot/a.c#2', '//depot/b.c#3'])
+
+        self.assertEqual(files, {'//depot/a.c#2': 'int a;\n\n',
+                                 '//depot/b.c#3': 'int b;\n'})
+
+    def test_no_separator(self):
+        """Testing p4 -G print with a file not ending in a newline"""
+        files = self._print([stat('//depot/a.c', 2), text('int a;'),
+                             stat('//depot/b.c', 3), text('int b;\n')],
+                            ['//depot/a.c#2', '//depot/b.c#3'])
+
+        self.assertEqual(files, {'//depot/a.c#2': 'int a;',
+                                 '//depot/b.c#3': 'int b;\n'})
+
+    def test_leading_empty_line(self):
+        """Testing p4 -G print with a file starting with an empty line"""
+        files = self._print([stat('//depot/a.c', 2), text('\n\nint a;\n')],
+                            ['//depot/a.c#2'])
+
+        self.assertEqual(files, {'//depot/a.c#2': '\n\nint a;\n'})
+
+    def test_empty_file(self):
+        """Testing p4 -G print with an empty file"""
+        files = self._print([stat('//depot/a.c', 2),
+                             stat('//depot/b.c', 3), text('int b;\n')],
+                            ['//depot/a.c#2', '//depot/b.c#3'])
+
+        self.assertEqual(files, {'//depot/a.c#2': '',
+                                 '//depot/b.c#3': 'int b;\n'})
+
+    def test_crlf(self):
+        """Testing p4 -G print with CRLF line endings"""
+        files = self._print([stat('//depot/a.c', 2),
+                             text('int a;\r'), text('\nint b;\r\n'),
+                             stat('//depot/a.gif', 1, 'binary'),
+                             binary('GIF\r\n\0')],
+                            ['//depot/a.c#2', '//depot/a.gif#1'])
+
+        # Only text files are translated, even if a "\r\n" is split between
+        # two chunks.
+        self.assertEqual(files, {'//depot/a.c#2': 'int a;\nint b;\n',
+                                 '//depot/a.gif#1': 'GIF\r\n\0'})
+
+    def test_depot_file_in_contents(self):
+        """Testing p4 -G print with contents that look like p4 fields"""
+        contents = ('... depotFile //depot/b.c\n'
+                    '... rev 3\n'
+                    '\n'
+                    'int b;\n')
+        files = self._print([stat('//depot/a.txt', 2, size=len(contents)),
+                             text(contents[:20]), text(contents[20:]),
+                             stat('//depot/b.c', 3), text('int c;\n')],
+                            ['//depot/a.txt#2', '//depot/b.c#3'])
+
+        self.assertEqual(files, {'//depot/a.txt#2': contents,
+                                 '//depot/b.c#3': 'int c;\n'})
+
+    def test_errors(self):
+        """Testing p4 -G print leaves out files that weren't printed"""
+        files = self._print([{'code': 'error', 'severity': 3, 'generic': 17,
+                              'data': '//depot/gone.c#1 - no such file(s).\n'},
+                             stat('//depot/a.c', 2), text('int a;\n')],
+                            ['//depot/gone.c#1', '//depot/a.c#2'])
+
+        self.assertEqual(files, {'//depot/a.c#2': 'int a;\n'})
+
+    def test_head_revision(self):
+        """Testing p4 -G print with a file spec without a revision"""
+        files = self._print([stat('//depot/a.c', 5), text('int a;\n')],
+                            ['//depot/a.c'])
+
+        self.assertEqual(files, {'//depot/a.c': 'int a;\n'})
+
+
+if __name__ == '__main__':
+    unittest.main()
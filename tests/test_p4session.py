@@ -0,0 +1,196 @@
+'''
+Tests for scm.p4session, run against results recorded from P4Python, so
+that neither P4Python nor a Perforce server is needed.
+
+    python -m unittest discover -s tests
+'''
+
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scm import p4print, p4session
+
+
+# Results of P4.run() as returned by P4Python 2010.1, with tagged output.
+RECORDED_RESULTS = {
+    ('print', '//depot/main/hello.c#2', '//depot/main/logo.gif#1'): [
+        {'depotFile': '//depot/main/hello.c', 'rev': '2', 'change': '12',
+         'action': 'edit', 'type': 'text', 'time': '1262304000',
+         'fileSize': '24'},
+        'int main()\r\n{\r\n}\r\n',
+        '/* */\n',
+        {'depotFile': '//depot/main/logo.gif', 'rev': '1', 'change': '3',
+         'action': 'add', 'type': 'binary', 'time': '1262300000',
+         'fileSize': '4'},
+        'GIF\0',
+    ],
+    ('where', '//depot/main/hello.c'): [
+        {'depotFile': '//depot/main/hello.c',
+         'clientFile': '//ws/main/hello.c',
+         'path': '/home/user/ws/main/hello.c'},
+    ],
+    ('fstat', '-Ol', '//depot/main/hello.c#2'): [
+        {'depotFile': '//depot/main/hello.c', 'headRev': '2',
+         'headType': 'text', 'fileSize': '24',
+         'otherOpen': ['bob@ws2', 'carol@ws3']},
+    ],
+}
+
+
+class FakeP4Exception(Exception):
+    pass
+
+
+class FakeP4(object):
+    """
+    Replays RECORDED_RESULTS in place of a P4Python connection.
+    """
+    warnings = []
+
+    def __init__(self):
+        self.tagged = True
+        self.errors = []
+        self.warnings = []
+        self._connected = False
+
+    def connect(self):
+        self._connected = True
+
+    def connected(self):
+        return self._connected
+
+    def disconnect(self):
+        self._connected = False
+
+    def run(self, *args):
+        self.warnings = list(FakeP4.warnings)
+        return RECORDED_RESULTS[args]
+
+
+class P4SessionTests(unittest.TestCase):
+    def setUp(self):
+        fake_module = types.ModuleType('P4')
+        fake_module.P4 = FakeP4
+        fake_module.P4Exception = FakeP4Exception
+        self.orig_p4 = p4session.P4
+        p4session.P4 = fake_module
+        FakeP4.warnings = []
+
+        self.session = p4session.P4Session()
+
+    def tearDown(self):
+        p4session.P4 = self.orig_p4
+
+    def test_print(self):
+        """Testing P4Session with p4 -ztag print"""
+        data = self.session.run(['p4', '-ztag', 'print',
+                                 '//depot/main/hello.c#2',
+                                 '//depot/main/logo.gif#1'])
+
+        self.assertEqual(data,
+                         '... depotFile //depot/main/hello.c\n'
+                         '... action edit\n'
+                         '... change 12\n'
+                         '... fileSize 24\n'
+                         '... rev 2\n'
+                         '... time 1262304000\n'
+                         '... type text\n'
+                         '\n'
+                         'int main()\n{\n}\n/* */\n'
+                         '... depotFile //depot/main/logo.gif\n'
+                         '... action add\n'
+                         '... change 3\n'
+                         '... fileSize 4\n'
+                         '... rev 1\n'
+                         '... time 1262300000\n'
+                         '... type binary\n'
+                         '\n'
+                         'GIF\0')
+
+    def test_print_raw(self):
+        """Testing P4Session with p4 -ztag print in raw mode"""
+        FakeP4.warnings = ['//depot/main/gone.c - no such file(s).']
+
+        data = self.session.run(['p4', '-ztag', 'print',
+                                 '//depot/main/hello.c#2',
+                                 '//depot/main/logo.gif#1'], raw=True)
+
+        self.assertTrue('int main()\r\n{\r\n}\r\n/* */\n' in data)
+        self.assertFalse('no such file' in data)
+
+    def test_print_marshalled(self):
+        """Testing P4Session with p4 -G print"""
+        FakeP4.warnings = ['//depot/main/gone.c - no such file(s).']
+
+        records = self.session.run(['p4', '-G', 'print',
+                                    '//depot/main/hello.c#2',
+                                    '//depot/main/logo.gif#1'])
+
+        self.assertEqual([record['code'] for record in records],
+                         ['stat', 'text', 'text', 'stat', 'binary', 'error'])
+        self.assertEqual(records[0]['fileSize'], '24')
+
+        files = p4print.split_print_records(records,
+                                            ['//depot/main/hello.c#2',
+                                             '//depot/main/logo.gif#1'])
+        self.assertEqual(files,
+                         {'//depot/main/hello.c#2': 'int main()\n{\n}\n/* */\n',
+                          '//depot/main/logo.gif#1': 'GIF\0'})
+
+    def test_warnings(self):
+        """Testing P4Session appends warnings to the output"""
+        FakeP4.warnings = ['//depot/main/gone.c - no such file(s).']
+
+        data = self.session.run(['p4', '-ztag', 'where',
+                                 '//depot/main/hello.c'])
+
+        self.assertTrue(data.endswith(
+            '\n//depot/main/gone.c - no such file(s).\n'))
+
+    def test_list_fields(self):
+        """Testing P4Session numbers the items of list fields"""
+        data = self.session.run(['p4', '-ztag', 'fstat', '-Ol',
+                                 '//depot/main/hello.c#2'])
+
+        self.assertEqual(data,
+                         '... depotFile //depot/main/hello.c\n'
+                         '... fileSize 24\n'
+                         '... headRev 2\n'
+                         '... headType text\n'
+                         '... otherOpen0 bob@ws2\n'
+                         '... otherOpen1 carol@ws3\n'
+                         '\n')
+
+        records = self.session.run(['p4', '-G', 'fstat', '-Ol',
+                                    '//depot/main/hello.c#2'])
+        self.assertEqual(records[0]['otherOpen0'], 'bob@ws2')
+        self.assertEqual(records[0]['otherOpen1'], 'carol@ws3')
+
+    def test_argument_file(self):
+        """Testing P4Session with arguments from p4 -x"""
+        fd, argfile = tempfile.mkstemp()
+        os.write(fd, '//depot/main/hello.c\n')
+        os.close(fd)
+
+        try:
+            data = self.session.run(['p4', '-x', argfile, '-ztag', 'where'])
+        finally:
+            os.unlink(argfile)
+
+        self.assertTrue('... path /home/user/ws/main/hello.c\n' in data)
+
+    def test_untagged(self):
+        """Testing P4Session leaves untagged commands to the p4 binary"""
+        self.assertRaises(p4session.P4SessionError, self.session.run,
+                          ['p4', 'describe', '-s', '12'])
+        self.assertRaises(p4session.P4SessionError, self.session.run,
+                          ['p4', 'print', '-q', '//depot/main/hello.c#2'])
+
+
+if __name__ == '__main__':
+    unittest.main()